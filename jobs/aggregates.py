@@ -0,0 +1,177 @@
+import importlib
+import logging
+from decimal import Decimal
+from functools import lru_cache
+from lazy import lazy_import
+from watermark import watermark_table, create_watermark_table, write_watermark
+
+pd = lazy_import('pandas')
+db = lazy_import('sqlalchemy')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED INCREMENTAL SALES AGGREGATES
+############################################
+
+# Daily summary tables of fact_sales and the dimension key of each
+AGGREGATES = {
+    'agg_daily_store_sales': 'store_key',
+    'agg_daily_movie_sales': 'movie_key',
+    'agg_daily_customer_sales': 'customer_key',
+}
+
+# Dialects with an INSERT ... ON DUPLICATE KEY / ON CONFLICT upsert
+UPSERT_DIALECTS = ['mysql', 'sqlite', 'postgresql']
+
+# Key of the sales without a dimension row, e.g. payments without a rental
+UNKNOWN_KEY = 0
+
+# Sales amounts are summed in cents, float sums of them drift
+CENTS = Decimal('0.01')
+
+# Watermark job of the summary tables: the last sales_key folded into them.
+# They hold exactly the sales up to it, never past the `fact_sales` watermark
+FOLD_JOB = 'fact_sales:aggregates'
+
+
+@lru_cache(maxsize=None)
+def aggregate_table(table):
+    """ A summary table: amount and count of the sales of one day and dimension member """
+    return db.Table(
+        table, db.MetaData(),
+        db.Column('date_key', db.Integer, primary_key=True, autoincrement=False),
+        db.Column(AGGREGATES[table], db.Integer, primary_key=True, autoincrement=False),
+        db.Column('sales_amount', db.Numeric(12, 2)),
+        db.Column('sales_count', db.Integer),
+    )
+
+
+@lru_cache(maxsize=None)
+def build_table(table):
+    """ The table a summary table is created and filled under, then renamed to `table` """
+    return aggregate_table(table).to_metadata(db.MetaData(), name='{}_build'.format(table))
+
+
+def sales_select(key, after_id, to_id):
+    """ Amount and count of the sales after `after_id` up to `to_id` by day and `key` """
+    fact = db.table('fact_sales', db.column('sales_key'), db.column('date_key'), db.column(key),
+                    db.column('sales_amount'))
+    member = db.func.coalesce(fact.c[key], UNKNOWN_KEY)
+    return db.select(
+        fact.c.date_key, member, db.func.round(db.func.sum(fact.c.sales_amount), 2), db.func.count()
+    ).where(fact.c.sales_key > int(after_id), fact.c.sales_key <= int(to_id)).group_by(fact.c.date_key, member)
+
+
+def folded_last_id(connection):
+    """ Fold watermark on `connection`, None when the summary tables must be rebuilt """
+    table = watermark_table()
+    return connection.execute(db.select(table.c.last_id).where(table.c.job == FOLD_JOB)).scalar()
+
+
+def rebuild_aggregate_tables(database, last_id):
+    """ Fill the summary tables from `fact_sales` up to `last_id` with one GROUP BY each
+
+    Each table is built under another name and renamed over the old one
+    once filled. The fold watermark is cleared first and set once every
+    table is renamed, a failed rebuild is started again by the next run.
+    """
+    with database.begin() as connection:
+        write_watermark(connection, FOLD_JOB)
+
+    inspector = db.inspect(database)
+    for table, key in AGGREGATES.items():
+        build = build_table(table)
+        build.drop(database, checkfirst=True)
+        build.create(database)
+        with database.begin() as connection:
+            connection.execute(build.insert().from_select(
+                ['date_key', key, 'sales_amount', 'sales_count'], sales_select(key, -1, last_id)))
+            if inspector.has_table(table):
+                connection.exec_driver_sql("DROP TABLE {}".format(table))
+            connection.exec_driver_sql("ALTER TABLE {} RENAME TO {}".format(build.name, table))
+        logger.info('aggregate table={} built last_id={}'.format(table, last_id))
+
+    with database.begin() as connection:
+        write_watermark(connection, FOLD_JOB, last_id)
+
+
+def reconcile_aggregates(database, last_id):
+    """ Bring the summary tables up to the `fact_sales` watermark `last_id`, creating them when missing
+
+    Sales loaded while `sales_aggregates` was off are folded in one
+    INSERT ... SELECT per table. Missing tables, and tables without a fold
+    watermark or ahead of `fact_sales`, are rebuilt.
+    """
+    last_id = -1 if last_id is None or pd.isnull(last_id) else int(last_id)
+    create_watermark_table(database)
+    with database.connect() as connection:
+        folded_id = folded_last_id(connection)
+
+    inspector = db.inspect(database)
+    if folded_id is None or folded_id > last_id or not all(inspector.has_table(t) for t in AGGREGATES):
+        return rebuild_aggregate_tables(database, last_id)
+    if folded_id < last_id:
+        with database.begin() as connection:
+            fold_sales(connection, last_id)
+
+
+def aggregate_deltas(chunk_df, key):
+    """ Amount and count of the sales of a chunk by day and `key`, as DBAPI rows """
+    delta_df = chunk_df.assign(**{key: chunk_df[key].fillna(UNKNOWN_KEY)}).groupby(
+        ['date_key', key]).agg(
+        sales_amount=('sales_amount', 'sum'), sales_count=('sales_key', 'count')).reset_index()
+    return [{'date_key': int(d), key: int(k), 'sales_amount': Decimal(a).quantize(CENTS), 'sales_count': int(c)}
+            for d, k, a, c in delta_df.itertuples(index=False)]
+
+
+def upsert_statement(connection, table, select=None):
+    """ INSERT adding to the amount and count of the rows that already exist, in the warehouse dialect
+
+    The rows are bound to the statement, or read by `select`. SQLite
+    stores NUMERIC values as REAL, the amounts are rounded to cents on
+    every fold so the float error doesn't add up.
+    """
+    name = connection.dialect.name
+    if name not in UPSERT_DIALECTS:
+        raise ValueError('Unsupported warehouse dialect for aggregates: {} (expected one of {})'.format(
+            name, ', '.join(UPSERT_DIALECTS)))
+
+    statement = importlib.import_module('sqlalchemy.dialects.{}'.format(name)).insert(table)
+    if select is not None:
+        statement = statement.from_select([c.name for c in table.columns], select)
+    if name == 'mysql':
+        return statement.on_duplicate_key_update(
+            sales_amount=db.func.round(table.c.sales_amount + statement.inserted.sales_amount, 2),
+            sales_count=table.c.sales_count + statement.inserted.sales_count)
+    return statement.on_conflict_do_update(
+        index_elements=[c.name for c in table.primary_key],
+        set_={'sales_amount': db.func.round(table.c.sales_amount + statement.excluded.sales_amount, 2),
+              'sales_count': table.c.sales_count + statement.excluded.sales_count})
+
+
+def fold_aggregates(connection, chunk_df):
+    """ Load callback adding the deltas of a loaded fact_sales chunk to the summary tables
+
+    Runs in the transaction of the chunk, so every sale is counted once,
+    and costs one upsert per table in proportion to the chunk. The chunk
+    must follow the fold watermark, which moves to its last sales_key.
+    """
+    for table, key in AGGREGATES.items():
+        rows = aggregate_deltas(chunk_df, key)
+        if rows:
+            connection.execute(upsert_statement(connection, aggregate_table(table)), rows)
+    write_watermark(connection, FOLD_JOB, chunk_df.sales_key.max())
+
+
+def fold_sales(connection, to_id):
+    """ Fold the sales after the fold watermark up to `to_id`, inside the caller's transaction
+
+    For sales loaded without folding each chunk, e.g. by partitions, in
+    the transaction that moves the `fact_sales` watermark past them.
+    """
+    after_id = folded_last_id(connection)
+    for table, key in AGGREGATES.items():
+        connection.execute(upsert_statement(connection, aggregate_table(table), sales_select(key, after_id, to_id)))
+    write_watermark(connection, FOLD_JOB, to_id)
+    logger.info('aggregate fold after_id={} to_id={}'.format(after_id, to_id))
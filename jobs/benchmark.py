@@ -0,0 +1,228 @@
+import argparse
+import importlib
+import json
+import os
+import shutil
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from lazy import lazy_import
+from functools import lru_cache, partial
+from engines import Engines
+from etl import JOBS, load_job
+from generate_sakila import generate_sakila, write_sakila, create_warehouse
+from metrics import job_stages, peak_rss_bytes
+from settings import DEFAULT_SETTINGS, read_config, setup_logging, etl_settings
+
+db = lazy_import('sqlalchemy')
+
+logger = logging.getLogger()
+
+############################################
+# FUNCTIONS
+############################################
+
+
+@lru_cache(maxsize=None)
+def converted_datetime_type():
+    """ SQLite DATETIME type of the benchmark engines, reading back converted datetimes as they are
+
+    SQLAlchemy parses the strings of its DateTime columns itself, a value
+    the sqlite3 converter already parsed would fail `fromisoformat`.
+    """
+    from sqlalchemy.dialects import sqlite
+
+    class ConvertedDateTime(sqlite.DATETIME):
+        def result_processor(self, dialect, coltype):
+            parse = super().result_processor(dialect, coltype)
+            return lambda value: parse(value) if isinstance(value, str) else value
+
+    return ConvertedDateTime
+
+
+def create_benchmark_engine(url):
+    """ Create the engine of a benchmark database URL
+
+    SQLite returns timestamps as strings unless their declared type has a
+    converter, the one registered here parses the DATETIME columns read by
+    pd.read_sql. It only applies to the connections of this engine, which
+    declare their types, and the engine's DateTime columns keep the
+    converted values. Worker processes create the engine again through this
+    function.
+    """
+    if not url.startswith('sqlite'):
+        return db.create_engine(url)
+
+    import sqlite3
+    from datetime import datetime
+    sqlite3.register_converter(
+        'DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+    engine = db.create_engine(url, connect_args={'detect_types': sqlite3.PARSE_DECLTYPES})
+    engine.dialect.colspecs = {**engine.dialect.colspecs, db.DateTime: converted_datetime_type()}
+    engine.factory = partial(create_benchmark_engine, url)
+    return engine
+
+
+def benchmark_job(name, source_url, warehouse_url, settings):
+    """ Run one job and measure it, called in a fresh process so the peak RSS is its own """
+    engines = Engines(create_benchmark_engine(source_url), create_benchmark_engine(warehouse_url))
+    module = load_job(name)
+
+    # Import the libraries before the clock starts, a job pays for them once per process
+    for library in ['pandas', 'pyarrow']:
+        importlib.import_module(library)
+
+    start_time = time.perf_counter()
+    row_count = module.run(engines, **settings)
+    seconds = time.perf_counter() - start_time
+
+    return {
+        'job': name,
+        'rows': row_count,
+        'seconds': seconds,
+        'rows_per_sec': row_count / seconds if seconds > 0 else 0,
+        'peak_rss_mb': (peak_rss_bytes() or 0) / 1024 ** 2,
+        'stages': job_stages(name),
+    }
+
+
+def prepare_source(scale, workdir, source_url=None):
+    """ Generate the synthetic source at `scale`, a SQLite file in `workdir` is reused """
+    if source_url is None:
+        path = os.path.join(workdir, 'sakila_x{}.db'.format(scale))
+        source_url = 'sqlite:///{}'.format(path)
+        if os.path.exists(path):
+            return source_url
+
+        # Generate into a temporary file so an interrupted run is never reused
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        database = create_benchmark_engine('sqlite:///{}.tmp'.format(path))
+        write_sakila(generate_sakila(scale), database)
+        database.dispose()
+        os.replace(path + '.tmp', path)
+        return source_url
+
+    write_sakila(generate_sakila(scale), create_benchmark_engine(source_url))
+    return source_url
+
+
+def run_benchmark(scale, workdir, settings, source_url=None, warehouse_url=None):
+    """ Run every job end to end on a synthetic source at `scale`, returns one result per job
+
+    Jobs run one at a time in dependency order, each in its own process,
+    against an empty warehouse and reference cache.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    source_url = prepare_source(scale, workdir, source_url)
+
+    if warehouse_url is None:
+        path = os.path.join(workdir, 'dw_x{}.db'.format(scale))
+        if os.path.exists(path):
+            os.remove(path)
+        warehouse_url = 'sqlite:///{}'.format(path)
+    create_warehouse(create_benchmark_engine(warehouse_url))
+
+    cache_dir = os.path.join(workdir, 'cache')
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    settings = dict(settings, reference_cache_dir=cache_dir)
+
+    results = []
+    # JOBS lists every job after its dependencies
+    for name in JOBS:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            result = pool.submit(benchmark_job, name, source_url, warehouse_url, settings).result()
+        result['scale'] = scale
+        results.append(result)
+    return results
+
+
+def format_results(results):
+    """ Text report: one line per job followed by its stages, slowest first, with rows in and out """
+    lines = ['{:>5} {:<14} {:>10} {:>9} {:>12} {:>9}'.format(
+        'scale', 'job', 'rows', 'seconds', 'rows/sec', 'rss MB')]
+    for result in results:
+        lines.append('{:>5} {:<14} {:>10} {:>9.3f} {:>12.0f} {:>9.1f}'.format(
+            result['scale'], result['job'], result['rows'], result['seconds'],
+            result['rows_per_sec'], result['peak_rss_mb']))
+        for stage in result['stages']:
+            lines.append('{:>5}   {:<30} {:>9.3f} {:>10} {:>10}'.format(
+                '', stage['stage'], stage['seconds'], stage['rows_in'], stage['rows_out']))
+    return '\n'.join(lines)
+
+
+def compare_baseline(results, baseline, tolerance):
+    """ Jobs whose rows/sec fell more than `tolerance` below the baseline results """
+    baseline = {(b['scale'], b['job']): b for b in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result['scale'], result['job']))
+        if previous and result['rows_per_sec'] < previous['rows_per_sec'] * (1 - tolerance):
+            regressions.append('scale={} job={} rows_per_sec={:.0f} baseline={:.0f}'.format(
+                result['scale'], result['job'], result['rows_per_sec'], previous['rows_per_sec']))
+    return regressions
+
+
+def parse_setting(assignment):
+    """ Parse a `name=value` setting override to the type of its default """
+    name, _, value = assignment.partition('=')
+    if name not in DEFAULT_SETTINGS:
+        raise argparse.ArgumentTypeError('unknown setting: {}'.format(name))
+    default = DEFAULT_SETTINGS[name]
+    if isinstance(default, bool):
+        return name, value.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return name, int(value)
+    return name, value
+
+
+def main(argv=None):
+    """ Command line entry point: benchmark all jobs at the given scales """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the jobs end to end on a synthetic Sakila database')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1],
+                        help='sizes as multiples of the Sakila sample, e.g. 1 10 100')
+    parser.add_argument('--workdir', default='bench',
+                        help='directory of the generated SQLite databases and the reference cache')
+    parser.add_argument('--source-url',
+                        help='generate into this database instead of SQLite, e.g. a local MySQL')
+    parser.add_argument('--warehouse-url',
+                        help='warehouse database instead of SQLite, its tables are dropped')
+    parser.add_argument('--set', type=parse_setting, action='append', default=[],
+                        metavar='NAME=VALUE', help='override an [etl] setting of conf/.env')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='rows/sec drop against the baseline reported as regression')
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    settings = dict(etl_settings(read_config()), **dict(args.set))
+
+    results = []
+    for scale in args.scale:
+        results += run_benchmark(scale, args.workdir, settings,
+                                 args.source_url, args.warehouse_url)
+    print(format_results(results))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'settings': settings, 'results': results}, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_baseline(results, json.load(baseline_file)['results'],
+                                           args.tolerance)
+        for regression in regressions:
+            logger.error('regression {}'.format(regression))
+        if regressions:
+            raise SystemExit(1)
+
+############################################
+# RUN
+############################################
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import threading
+import tracemalloc
+import logging
+from metrics import current_rss_bytes
+
+logger = logging.getLogger()
+
+############################################
+# SHARED MEMORY-BUDGETED BATCH SIZING
+############################################
+
+# Rows of the first page of a budgeted job, measured to size the next ones
+PROBE_BATCH_SIZE = 10000
+
+# Bounds of a budgeted page size
+MIN_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 1000000
+
+# Share of the free budget a page may take, the rest absorbs the estimate error
+BUDGET_SHARE = 0.8
+
+# One measured batch at a time, tracemalloc traces the whole process
+measure_lock = threading.Lock()
+
+
+def batch_sizer(job, settings):
+    """ Page size state of one job run, sized by `memory_budget_mb` when it is set
+
+    Without a budget every page has batch_size rows. With one, the first
+    page has at most PROBE_BATCH_SIZE rows and its footprint is measured
+    across all the stages of the batch, the next pages are sized to fit
+    the budget, see `run_measured`. Only `stream` extract mode has pages.
+    """
+    budget = 0
+    if settings['extract_mode'] == 'stream':
+        budget = settings['memory_budget_mb'] * 1024 ** 2
+    return {
+        'job': job,
+        'budget': budget,
+        'batch_size': min(settings['batch_size'], PROBE_BATCH_SIZE) if budget else settings['batch_size'],
+        'row_bytes': None,
+    }
+
+
+def next_batch_size(sizer):
+    """ Rows of the next page, the `batch_size` argument of the `stream_*` functions """
+    return sizer['batch_size']
+
+
+def budget_batch_size(sizer):
+    """ Rows fitting the free budget at the measured bytes per row """
+    free_bytes = sizer['budget'] - (current_rss_bytes() or 0)
+    batch_size = int(free_bytes * BUDGET_SHARE / max(sizer['row_bytes'], 1))
+    return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, batch_size))
+
+
+def run_measured(sizer, run_batch, batch_df, *args):
+    """ Run one batch with `run_batch(batch_df, *args)` and size the next page
+
+    The first batch runs under tracemalloc: its traced peak divided by its
+    rows is the footprint of a row through the lookups, merges and load of
+    the batch. Arrow buffers aren't traced, the estimate is lower with the
+    `arrow` extract backend. Every later page takes what the budget leaves
+    over the current RSS.
+    """
+    if not sizer['budget']:
+        return run_batch(batch_df, *args)
+
+    if sizer['row_bytes'] is None:
+        with measure_lock:
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            try:
+                row_count = run_batch(batch_df, *args)
+                _, peak_bytes = tracemalloc.get_traced_memory()
+            finally:
+                if not tracing:
+                    tracemalloc.stop()
+        sizer['row_bytes'] = peak_bytes / max(batch_df.shape[0], 1)
+    else:
+        row_count = run_batch(batch_df, *args)
+
+    sizer['batch_size'] = budget_batch_size(sizer)
+    logger.info('budget job={} row_bytes={:.0f} rss_mb={:.1f} batch_size={}'.format(
+        sizer['job'], sizer['row_bytes'], (current_rss_bytes() or 0) / 1024 ** 2,
+        sizer['batch_size']))
+    return row_count
@@ -0,0 +1,191 @@
+import logging
+from collections import namedtuple
+from functools import partial
+from lazy import lazy_import
+from loader import load_dataframe, update_dataframe
+from scd2 import lookup_scd2_versions, new_scd2_versions, record_scd2_baseline, close_replaced_versions
+from row_hash import CHANGED, HASH_COLUMNS, diff_row_hashes, hash_sink, record_baseline, write_row_hashes
+from watermark import read_watermark, write_watermark, advance_watermark, advance_id_watermark
+from staging import not_loaded
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED DIMENSION CHANGE CAPTURE
+############################################
+
+# How a dimension job finds the rows to write: new ids, source rows
+# changed since a `last_update` watermark, or row hashes of the whole table
+CHANGE_CAPTURES = ['id', 'last_update', 'hash']
+
+# A dimension loaded by change capture: its warehouse `table`, natural
+# `key`, business `columns` and the start date of the first version of a
+# key. Without `first_start` the dimension keeps no versions, a changed
+# row is overwritten in place.
+Dimension = namedtuple('Dimension', ['table', 'key', 'columns', 'first_start'], defaults=[None])
+
+
+def capture_mode(dimension, settings):
+    """ Change capture of a dimension, raises on an unknown one
+
+    A dimension without versions has no use for `last_update`, it keeps
+    loading by id.
+    """
+    change_capture = settings['change_capture']
+    if change_capture not in CHANGE_CAPTURES:
+        raise ValueError('Unknown change capture: {} (expected one of {})'.format(
+            change_capture, ', '.join(CHANGE_CAPTURES)))
+    if change_capture == 'last_update' and dimension.first_start is None:
+        return 'id'
+    return change_capture
+
+
+def last_loaded_id(dimension, database):
+    """ Last natural key loaded by id into a dimension """
+    watermark = read_watermark(dimension.table, database)
+    if watermark is not None:
+        return watermark['last_id']
+
+    # Warehouses loaded before the watermark control table: scan the table
+    query = "SELECT max({}) AS last_id FROM {}".format(dimension.key, dimension.table)
+    tdf = pd.read_sql(query, database)
+    return tdf.iloc[0]['last_id']
+
+
+def update_job(dimension):
+    """ Watermark job of the `last_update` change capture of a dimension """
+    return '{}:last_update'.format(dimension.table)
+
+
+def last_captured_update(dimension, database):
+    """ Latest source `last_update` captured in a dimension and the last key captured at it
+
+    The key is None when unknown, the rows updated at the watermark itself
+    are then read again.
+    """
+    watermark = read_watermark(update_job(dimension), database)
+    if watermark is not None:
+        return watermark['last_update'], watermark['last_id']
+
+    # Warehouses loaded before the watermark control table: scan the table
+    query = "SELECT max(last_update) AS last_update FROM {}".format(dimension.table)
+    tdf = pd.read_sql(query, database)
+    return tdf.iloc[0]['last_update'], None
+
+
+def capture_source(dimension, settings, database, by_id, changed=None, pushdown=None):
+    """ Watermark and `extract` and `stream` functions of the change capture of a dimension
+
+    `by_id`, `changed` and `pushdown` are the job's (extract, stream) pairs
+    of the new source rows by id, of the rows changed since a `last_update`
+    watermark, and of the new rows already joined by the source database.
+    A hash diff compares the whole table on every run, there is no
+    watermark.
+    """
+    change_capture = capture_mode(dimension, settings)
+    if change_capture == 'last_update':
+        # Rows updated since the latest captured (`last_update`, key) are versioned
+        watermark, last_id = last_captured_update(dimension, database)
+        logger.debug('watermark={} last_id={}'.format(watermark, last_id))
+        extract, stream = changed
+        return watermark, partial(extract, last_id=last_id), partial(stream, last_id=last_id)
+
+    extract, stream = pushdown if pushdown is not None and settings['join_pushdown'] else by_id
+    if change_capture == 'hash':
+        return None, extract, stream
+
+    last_id = last_loaded_id(dimension, database)
+    logger.debug('last_id={}'.format(last_id))
+    return last_id, extract, stream
+
+
+def staged_pending(dimension, settings, database):
+    """ `pending` filter of the batches a failed run left in the staging area
+
+    Loads by id skip the rows already loaded, versioned and hashed batches
+    are transformed again since their rows depend on the warehouse.
+    """
+    if capture_mode(dimension, settings) != 'id':
+        return None
+    return not_loaded(dimension.key, last_loaded_id(dimension, database))
+
+
+def capture_changes(dim_df, source_df, dimension, settings, database):
+    """ Keep the rows of a transformed batch the change capture writes
+
+    `last_update` turns the changed rows into versions against the ones in
+    the warehouse, a hash diff keeps the new and changed rows, a changed
+    one is versioned as of now. Both add a `row_status`, see
+    `write_changes`.
+    """
+    change_capture = capture_mode(dimension, settings)
+    if change_capture == 'last_update':
+        # The open version of a changed key is closed on load
+        dim_df['last_update'] = dim_df[dimension.key].map(source_df.set_index(dimension.key).last_update)
+        versions_df = lookup_scd2_versions(dimension.table, dimension.key, dim_df[dimension.key], database)
+        return new_scd2_versions(dim_df, versions_df, dimension.key, dimension.first_start)
+
+    if change_capture == 'hash':
+        dim_df = diff_row_hashes(dim_df, dimension.table, dimension.key, dimension.columns, database)
+    if dimension.first_start is not None:
+        dim_df['start_date'] = dimension.first_start
+        if change_capture == 'hash':
+            dim_df.loc[dim_df.row_status == CHANGED, 'start_date'] = str(pd.Timestamp.now().floor('s'))
+    return dim_df
+
+
+def write_changes(dim_df, dimension, settings, database):
+    """ Record the rows a batch only baselines, then load the others, returns the written row count
+
+    Each chunk advances the watermark of the change capture. Versioned
+    loads close the open versions a chunk replaces in the transaction of
+    the chunk, and keep the id watermark ahead of their new rows, for a
+    switch back to loads by id.
+    """
+    table, key, columns = dimension.table, dimension.key, dimension.columns
+    strategy, chunksize = settings['load_strategy'], settings['load_chunksize']
+    change_capture = capture_mode(dimension, settings)
+    if change_capture == 'id':
+        return load_dataframe(dim_df, table, database, strategy, chunksize, advance_watermark(table, key))
+
+    sinks = [advance_id_watermark(table, table, key, database)]
+    pre_load = [close_replaced_versions(table, key)] if dimension.first_start is not None else []
+    if change_capture == 'last_update':
+        # Only stamp the rows loaded before the first versioned run
+        dim_df = record_scd2_baseline(dim_df, table, key, database)
+        return load_dataframe(dim_df.drop(columns=['row_status']), table, database, strategy, chunksize,
+                              advance_watermark(update_job(dimension), key, 'last_update'),
+                              sinks=sinks, pre_load=pre_load)
+
+    # Only record the hashes of the rows loaded before the first hash run
+    dim_df = record_baseline(dim_df, table, key, columns, database)
+    row_count = 0
+    if dimension.first_start is None:
+        # Without versions a changed row is overwritten together with its hash
+        changed = dim_df.row_status == CHANGED
+        with database.begin() as connection:
+            update_dataframe(dim_df.loc[changed, columns], table, key, connection)
+            write_row_hashes(connection, table, key, dim_df[changed], columns)
+        row_count, dim_df = int(changed.sum()), dim_df[~changed]
+
+    # Each chunk stores the hashes of its rows
+    return row_count + load_dataframe(dim_df.drop(columns=HASH_COLUMNS), table, database, strategy, chunksize,
+                                      sinks=[hash_sink(table, key, columns)] + sinks, pre_load=pre_load)
+
+
+def advance_capture(page_df, dimension, settings, database):
+    """ Advance the `last_update` watermark past an extracted page once the page is written
+
+    The chunks only advance it to the versions they insert, a page whose
+    last rows were only stamped as baseline or dropped as already applied
+    would be read again by every run. Pages are extracted in
+    (`last_update`, key) order, the last row ends the page.
+    """
+    if capture_mode(dimension, settings) != 'last_update' or page_df.shape[0] == 0:
+        return
+
+    last_row = page_df.iloc[-1]
+    with database.begin() as connection:
+        write_watermark(connection, update_job(dimension), last_row[dimension.key], last_row['last_update'])
@@ -0,0 +1,52 @@
+from collections import namedtuple
+from functools import partial
+from lazy import lazy_import
+
+db = lazy_import('sqlalchemy')
+
+############################################
+# SHARED DATABASE ENGINES
+############################################
+
+# Source database and data warehouse engines, shared by all jobs
+Engines = namedtuple('Engines', ['db_engine', 'dw_engine'])
+
+
+def create_engine(config, section, **kwargs):
+    """ Create the engine of one `conf/.env` database section """
+    url = "mysql+pymysql://{}:{}@{}:{}/{}".format(
+        config[section]['user'],
+        config[section]['password'],
+        config[section]['host'],
+        config[section]['port'],
+        config[section]['db']
+    )
+    engine = db.create_engine(url, **kwargs)
+    engine.factory = partial(db.create_engine, url, **kwargs)
+    return engine
+
+
+def engine_factory(engine):
+    """ Picklable function creating `engine` again, engines can't be passed to worker processes
+
+    Engines keep the function they can be created again with in `factory`,
+    the others are created again from their URL only.
+    """
+    factory = getattr(engine, 'factory', None)
+    if factory is None:
+        factory = partial(db.create_engine, engine.url.render_as_string(hide_password=False))
+    return factory
+
+
+def create_engines(config):
+    """ Create the source database and data warehouse engines shared by all jobs """
+    load_strategy = config.get('etl', 'load_strategy', fallback='to_sql')
+
+    # Database connection URI
+    db_engine = create_engine(config, 'database')
+
+    # Data warehouse connection URI
+    dw_engine = create_engine(config, 'data-warehouse',
+                              connect_args={'local_infile': load_strategy == 'infile'})
+
+    return Engines(db_engine, dw_engine)
@@ -0,0 +1,132 @@
+import argparse
+import importlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from engines import create_engines
+from metrics import instrument, job_stages, record_job, write_summary, write_prometheus
+from settings import read_config, setup_logging, etl_settings
+
+logger = logging.getLogger()
+
+# Job modules and the jobs that must be loaded before them
+JOBS = {
+    'dim_customer': ('etl_dim_customer', []),
+    'dim_movie': ('etl_dim_movie', []),
+    'dim_store': ('etl_dim_store', []),
+    'dim_date': ('generate_dim_date', []),
+    'fact_sales': ('etl_fact_sales', ['dim_customer', 'dim_movie', 'dim_store', 'dim_date']),
+}
+
+############################################
+# FUNCTIONS
+############################################
+
+
+def load_job(name):
+    """ Import a job module on first use, its stages instrumented """
+    return instrument(importlib.import_module(JOBS[name][0]), name)
+
+
+def run_job(name, engines, settings):
+    """ Run one job and log its row count and duration """
+    start_time = time.perf_counter()
+    try:
+        row_count = load_job(name).run(engines, **settings)
+    except Exception:
+        record_job(name, 'failed', time.perf_counter() - start_time)
+        raise
+    seconds = time.perf_counter() - start_time
+    record_job(name, 'success', seconds, row_count)
+    logger.info('job={} rows={} seconds={:.3f}'.format(name, row_count, seconds))
+
+    for stage in job_stages(name):
+        logger.debug('job={job} stage={stage} calls={calls} seconds={seconds:.3f} '
+                     'rows_in={rows_in} rows_out={rows_out} bytes={bytes}'.format(**stage))
+
+    if row_count == 0:
+        logger.warning('job={} no new record in source table'.format(name))
+    return row_count
+
+
+def run_jobs(engines, names=None, max_workers=4, settings=None):
+    """ Run jobs in dependency order, independent jobs concurrently
+
+    Runs `names`, or all jobs when None, on the given engines. A job starts
+    as soon as all of its selected dependencies succeeded; when a job fails,
+    the jobs depending on it are skipped and the others still run. Returns
+    the names of the failed and skipped jobs.
+    """
+    names = list(JOBS) if names is None else list(names)
+    settings = settings or {}
+    pending = {n: [d for d in JOBS[n][1] if d in names] for n in names}
+    succeeded = set()
+    failed = []
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name, dependencies in list(pending.items()):
+                if any(d in failed for d in dependencies):
+                    logger.error('job={} skipped: dependency failed'.format(name))
+                    record_job(name, 'skipped', 0)
+                    failed.append(name)
+                    del pending[name]
+                elif all(d in succeeded for d in dependencies):
+                    running[pool.submit(run_job, name, engines, settings)] = name
+                    del pending[name]
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is None:
+                    succeeded.add(name)
+                else:
+                    logger.error('job={} failed'.format(name), exc_info=future.exception())
+                    failed.append(name)
+
+    return failed
+
+
+def main(argv=None):
+    """ Command line entry point: run the given jobs, or all of them """
+    config = read_config()
+
+    parser = argparse.ArgumentParser(
+        description='Run ETL jobs; dimension jobs run concurrently, then fact_sales')
+    parser.add_argument('jobs', nargs='*', metavar='job',
+                        help='jobs to run, all when omitted: {}'.format(', '.join(JOBS)))
+    parser.add_argument('--workers', type=int,
+                        default=config.getint('etl', 'job_workers', fallback=4),
+                        help='jobs running concurrently')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.jobs if name not in JOBS]
+    if unknown:
+        parser.error('unknown job(s): {}'.format(', '.join(unknown)))
+
+    setup_logging()
+    engines = create_engines(config)
+    failed = run_jobs(engines, args.jobs or None, args.workers, etl_settings(config))
+
+    # Run summary for dashboards and alerting, also written when a job failed
+    summary_path = config.get('etl', 'metrics_summary', fallback='')
+    if summary_path:
+        write_summary(summary_path)
+    textfile_path = config.get('etl', 'metrics_textfile', fallback='')
+    if textfile_path:
+        write_prometheus(textfile_path)
+
+    if failed:
+        raise SystemExit(1)
+
+############################################
+# RUN
+############################################
+
+
+if __name__ == '__main__':
+    main()
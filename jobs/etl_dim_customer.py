@@ -1,193 +1,265 @@
-import pandas as pd
-import sqlalchemy as db
-import configparser
 import logging
-from logging.config import fileConfig
+from functools import partial
+from lazy import lazy_import
+from extract import (stream_pages, stream_changes, changed_rows_condition,
+                     read_source, limit_clause, lookup_by_ids, select_list, extract_batches)
+from joins import JoinStep, join_chain
+from refcache import lookup_reference
+from capture import (Dimension, capture_source, staged_pending, capture_changes, write_changes,
+                     advance_capture)
+from staging import run_staged, resume_staged
+from budget import batch_sizer, next_batch_size, run_measured
+from parquet_sink import export_snapshot
+from settings import resolve_settings
+
+pd = lazy_import('pandas')
 
-# Configs
-config = configparser.ConfigParser()
-config.read('conf/.env')
-
-fileConfig('conf/logging_config.ini')
 logger = logging.getLogger()
 
-# Database connection URI
-db_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['database']['user'],
-        config['database']['password'],
-        config['database']['host'],
-        config['database']['port'],
-        config['database']['db']
-    )
-)
-
-# Data warehouse connection URI
-dw_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['data-warehouse']['user'],
-        config['data-warehouse']['password'],
-        config['data-warehouse']['host'],
-        config['data-warehouse']['port'],
-        config['data-warehouse']['db']
-    )
-)
-
-# engine testing and just uncomment
-"""
-try:
-    db_engine.connect()
-    dw_engine.connect()
-    print('connection success')
-except:
-    print('DB error or check the connection')
-"""
+# Columns consumed from each table, pushed down into the extract and lookup SELECTs
+COLUMNS = {
+    'customer': ['customer_id', 'first_name', 'last_name', 'email', 'address_id', 'active', 'create_date'],
+    'address': ['address_id', 'address', 'address2', 'district', 'city_id', 'postal_code', 'phone'],
+    'city': ['city_id', 'city', 'country_id'],
+    'country': ['country_id', 'country'],
+}
+
+# Join chain of `customer` -> `address` -> `city` -> `country` and the dimension columns
+JOINS = [
+    JoinStep('address_id', 'address', 'address_id',
+             ['address', 'address2', 'district', 'city_id', 'postal_code', 'phone']),
+    JoinStep('city_id', 'city', 'city_id', ['city', 'country_id']),
+    JoinStep('country_id', 'country', 'country_id', ['country']),
+]
+DIM_COLUMNS = ['customer_id', 'first_name', 'last_name', 'email', 'address', 'address2',
+               'district', 'city', 'country', 'postal_code', 'phone', 'active', 'create_date']
+
+# Start date of the first version of a customer, older than any fact
+FIRST_START_DATE = '1970-01-01'
+
+# Change capture of `dim_customer`, see `capture.py`
+DIMENSION = Dimension('dim_customer', 'customer_id', DIM_COLUMNS, FIRST_START_DATE)
 
 ############################################
 # FUNCTIONS
 ############################################
 
 
-def get_dimCustomer_last_id(database):
-    """ Function to get last customer_id from dimension table `dim_customer` """
-    query = "SELECT max(customer_id) AS last_id FROM dim_customer"
-    tdf = pd.read_sql(query, database)
-    return tdf.iloc[0]['last_id']
-
-
-def extract_table_customer(last_id, database):
+def extract_table_customer(last_id, database, batch_size=100000, chunksize=None):
     """ Function to extract table `customer` """
     if last_id == None:
         last_id = -1
 
-    query = "SELECT * FROM customer WHERE customer_id > {} LIMIT 100000".format(
-        last_id)
-    return pd.read_sql(query, database)
+    query = "SELECT {} FROM customer WHERE customer_id > {} ORDER BY customer_id {}".format(
+        select_list(COLUMNS['customer']), last_id, limit_clause(batch_size))
+    return read_source(query, 'customer', database, chunksize=chunksize)
 
 
-def lookup_table_address(customer_df, database):
-    """ Function to lookup table `address` """
-    unique_ids = list(customer_df.address_id.unique())
-    unique_ids = list(filter(None, unique_ids))
+def stream_table_customer(last_id, database, batch_size=100000):
+    """ Generator: extract table `customer` page by page until the backlog is drained """
+    return stream_pages(extract_table_customer, 'customer_id', last_id, database, batch_size)
 
-    query = "SELECT * FROM address WHERE address_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
 
+def extract_changed_customer(watermark, database, batch_size=100000, last_id=None, chunksize=None):
+    """ Function to extract the rows of table `customer` updated since the watermark """
+    query = "SELECT {}, last_update FROM customer WHERE {} ORDER BY last_update, customer_id {}".format(
+        select_list(COLUMNS['customer']), changed_rows_condition('customer_id', watermark, last_id), limit_clause(batch_size))
+    return read_source(query, 'customer', database, chunksize=chunksize)
 
-def lookup_table_city(address_df, database):
-    """ Function to lookup table `city` """
-    unique_ids = list(address_df.city_id.unique())
-    unique_ids = list(filter(None, unique_ids))
 
-    query = "SELECT * FROM city WHERE city_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
+def stream_changed_customer(watermark, database, batch_size=100000, last_id=None):
+    """ Generator: extract changed rows page by page until the backlog is drained """
+    return stream_changes(extract_changed_customer, 'customer_id', watermark, database, batch_size, last_id)
 
 
-def lookup_table_country(address_df, database):
-    """ Function to lookup table `country` """
-    unique_ids = list(address_df.country_id.unique())
-    unique_ids = list(filter(None, unique_ids))
+def extract_dim_customer(last_id, database, batch_size=100000, chunksize=None):
+    """ Pushdown: extract table `customer` joined with `address`, `city` and `country` by the source """
+    if last_id == None:
+        last_id = -1
 
-    query = "SELECT * FROM country WHERE country_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
+    query = """
+        SELECT c.customer_id, c.first_name, c.last_name, c.email, a.address,
+               a.address2, a.district, ci.city, co.country, a.postal_code,
+               a.phone, c.active, c.create_date
+        FROM customer c
+        LEFT JOIN address a ON a.address_id = c.address_id
+        LEFT JOIN city ci ON ci.city_id = a.city_id
+        LEFT JOIN country co ON co.country_id = ci.country_id
+        WHERE c.customer_id > {} ORDER BY c.customer_id {}
+    """.format(last_id, limit_clause(batch_size))
+    return read_source(query, 'customer', database, chunksize=chunksize)
+
+
+def stream_dim_customer(last_id, database, batch_size=100000):
+    """ Generator: pushdown extract page by page until the backlog is drained """
+    return stream_pages(extract_dim_customer, 'customer_id', last_id, database, batch_size)
+
+
+def lookup_table_customer(dim_customer_df, database):
+    """ Function to lookup table `customer` """
+    return lookup_by_ids('customer', 'customer_id', dim_customer_df.customer_id,
+                         database, COLUMNS['customer'])
+
+
+def lookup_table_address(customer_df, database, cache_dir=''):
+    """ Function to lookup table `address` """
+    return lookup_reference('address', 'address_id', customer_df.address_id,
+                            database, cache_dir, COLUMNS['address'])
 
 
-def join_customer_address(customer_df, address_df):
-    """ Transformation: join table `customer` and `address` """
-    customer_df = pd.merge(customer_df, address_df,
-                           left_on='address_id', right_on='address_id', how='left')
-    customer_df = customer_df[['customer_id', 'first_name', 'last_name', 'email', 'address',
-                               'address2', 'district', 'city_id', 'postal_code', 'phone', 'active', 'create_date']]
-    return customer_df
+def lookup_table_city(address_df, database, cache_dir=''):
+    """ Function to lookup table `city` """
+    return lookup_reference('city', 'city_id', address_df.city_id,
+                            database, cache_dir, COLUMNS['city'])
 
 
-def join_customer_city(customer_df, city_df):
-    """ Transformation: join table `customer` and `city` """
-    customer_df = pd.merge(customer_df, city_df,
-                           left_on='city_id', right_on='city_id', how='left')
-    customer_df = customer_df[['customer_id', 'first_name', 'last_name', 'email', 'address',
-                               'address2', 'district', 'city', 'country_id', 'postal_code', 'phone', 'active', 'create_date']]
-    return customer_df
+def lookup_table_country(address_df, database, cache_dir=''):
+    """ Function to lookup table `country` """
+    return lookup_reference('country', 'country_id', address_df.country_id,
+                            database, cache_dir, COLUMNS['country'])
 
 
-def join_customer_country(customer_df, country_df):
-    """ Transfprmation: join table `customer` and `country` """
-    customer_df = pd.merge(customer_df, country_df,
-                           left_on='country_id', right_on='country_id', how='left')
-    customer_df = customer_df[['customer_id', 'first_name', 'last_name', 'email', 'address',
-                               'address2', 'district', 'city', 'country', 'postal_code', 'phone', 'active', 'create_date']]
-    return customer_df
+def join_customer_lookups(customer_df, lookups):
+    """ Transformation: join table `customer` with `address`, `city` and `country` """
+    return join_chain(customer_df, JOINS, lookups, DIM_COLUMNS)
 
 
-def validate(source_df, destination_df):
+def validate(source_df, destination_df, expected_df=None):
     """ Function to validate transformation result """
     source_row_count = source_df.shape[0]
     destination_row_count = destination_df.shape[0]
 
-    if(source_row_count == destination_row_count):
-        return destination_df
-    else:
+    if(source_row_count != destination_row_count):
         raise ValueError(
             'Transformation result is not valid: row count is not equal'
         )
 
+    # Make sure the pushdown join returns the same rows as the pandas merges
+    if expected_df is not None:
+        try:
+            pd.testing.assert_frame_equal(
+                destination_df[expected_df.columns].sort_values('customer_id').reset_index(drop=True),
+                expected_df.sort_values('customer_id').reset_index(drop=True),
+                check_dtype=False, check_categorical=False)
+        except AssertionError as error:
+            raise ValueError(
+                'Transformation result is not valid: pushdown join differs from pandas merge\n{}'.format(error))
+    return destination_df
+
+
+def merge_customer_address_chain(customer_df, database, cache_dir):
+    """ Lookup `address`, `city` and `country` and join them to `customer` in pandas """
+    # Extract lookup table `address`
+    address_df = lookup_table_address(customer_df, database, cache_dir)
+
+    # Extract lookup table `city`
+    city_df = lookup_table_city(address_df, database, cache_dir)
+
+    # Extract lookup table `country`
+    country_df = lookup_table_country(city_df, database, cache_dir)
+
+    # Join table `customer` with `address`, `city` and `country`
+    return join_customer_lookups(customer_df, {
+        'address': address_df, 'city': city_df, 'country': country_df})
+
+
+def transform_batch(customer_df, engines, settings):
+    """ Lookup and transform one batch of `customer` rows """
+    db_engine, dw_engine = engines
+    # The reference cache refreshes by `last_update`, a hash diff reads the source
+    cache_dir = settings['reference_cache_dir'] if settings['change_capture'] != 'hash' else ''
+
+    expected_df = None
+    if settings['join_pushdown'] and settings['change_capture'] in ('id', 'hash'):
+        # The source database already joined `address`, `city` and `country`
+        dim_customer_df = customer_df.copy()
+        if settings['validate_pushdown']:
+            expected_df = merge_customer_address_chain(
+                lookup_table_customer(customer_df, db_engine), db_engine, cache_dir)
+    else:
+        dim_customer_df = merge_customer_address_chain(customer_df, db_engine, cache_dir)
 
-def load_dim_store(destination_df):
-    """ Load to data warehouse """
-    destination_df.to_sql('dim_customer', dw_engine,
-                          if_exists='append', index=False)
-
-############################################
-# EXTRACT
-############################################
-
+    # Validate result
+    dim_customer_df = validate(customer_df, dim_customer_df, expected_df)
+    logger.debug('dim_customer_df=\n{}'.format(dim_customer_df.dtypes))
 
-# Get last customer_id from dim_customer data warehouse
-last_id = get_dimCustomer_last_id(dw_engine)
-logger.debug('last_id={}'.format(last_id))
+    # Keep the new and changed customers
+    return capture_changes(dim_customer_df, customer_df, DIMENSION, settings, dw_engine)
 
-# Extract the store table into a pandas DataFrame
-customer_df = extract_table_customer(last_id, db_engine)
 
-# If no records fetched, then exit
-if customer_df.shape[0] == 0:
-    raise Exception('No new record in source table')
+def write_batch(dim_customer_df, database, settings):
+    """ Record the rows the batch only baselines, then load the others """
+    return write_changes(dim_customer_df, DIMENSION, settings, database)
 
-# Extract lookup table `address`
-address_df = lookup_table_address(customer_df, db_engine)
 
-# Extract lookup table `city`
-city_df = lookup_table_city(address_df, db_engine)
+def run_batch(customer_df, engines, settings):
+    """ Transform and load one batch of `customer` rows, checkpointed in the staging area """
+    row_count = run_staged('dim_customer', customer_df, 'customer_id',
+                           partial(transform_batch, engines=engines, settings=settings),
+                           partial(write_batch, database=engines.dw_engine, settings=settings),
+                           settings['staging_dir'])
 
-# Extract lookup table `country`
-country_df = lookup_table_country(city_df, db_engine)
+    # The whole page is captured, whatever rows it wrote
+    advance_capture(customer_df, DIMENSION, settings, engines.dw_engine)
+    return row_count
 
 ############################################
-# TRANSFORM
+# RUN
 ############################################
 
-# Join table `customer` with `address`
-dim_customer_df = join_customer_address(customer_df, address_df)
-
-# Join table `customer` with `city`
-dim_customer_df = join_customer_city(dim_customer_df, city_df)
-
-# Join table `customer` with `country`
-dim_customer_df = join_customer_country(dim_customer_df, country_df)
-
-# Add start_date column
-dim_customer_df['start_date'] = '1970-01-01'
-
-# Validate result
-dim_customer_df = validate(customer_df, dim_customer_df)
-logger.debug('dim_customer_df=\n{}'.format(dim_customer_df.dtypes))
-
-############################################
-# LOAD
-############################################
 
-# Load dimension table `dim_customer`
-load_dim_store(dim_customer_df)
+def run(engines, **overrides):
+    """ Run the job on the given engines, returns the number of loaded rows
+
+    Keyword arguments override the job settings, e.g. `batch_size=50000`.
+    """
+    settings = resolve_settings(overrides)
+    db_engine, dw_engine = engines
+
+    row_count = 0
+    if settings['staging_dir']:
+        # Finish the batches a failed run left in the staging area. Loads by
+        # id skip the rows already loaded, versioned batches are transformed
+        # again since their versions depend on the warehouse
+        row_count += resume_staged(
+            'dim_customer', partial(transform_batch, engines=engines, settings=settings),
+            partial(write_batch, database=dw_engine, settings=settings),
+            settings['staging_dir'], staged_pending(DIMENSION, settings, dw_engine))
+
+    # Rows changed since the last captured `last_update`, new rows by id, or
+    # without a trustworthy `last_update` the whole customer table compared by
+    # row hash. Loads by id read the customer table, or with pushdown the customer
+    # table already joined by the source database
+    last_id, extract, stream = capture_source(
+        DIMENSION, settings, dw_engine, (extract_table_customer, stream_table_customer),
+        (extract_changed_customer, stream_changed_customer), (extract_dim_customer, stream_dim_customer))
+
+    # Extract into pandas DataFrames, either one batch or keyset pages until
+    # the whole backlog is drained
+    sizer = batch_sizer('dim_customer', settings)
+    # A hash diff walks the whole table, in batch mode too
+    customer_batches = extract_batches(settings['extract_mode'], extract, stream, last_id, db_engine,
+                                       settings['batch_size'], partial(next_batch_size, sizer),
+                                       pages=settings['change_capture'] == 'hash')
+
+    batch_count = 0
+    for customer_df in customer_batches:
+        # Stop at the first empty page
+        if customer_df.shape[0] == 0:
+            break
+
+        # Already captured changes are skipped, count the loaded rows
+        row_count += run_measured(sizer, run_batch, customer_df, engines, settings)
+        batch_count += 1
+        logger.debug('batch={} rows={}'.format(batch_count, customer_df.shape[0]))
+
+    # Snapshot the dimension next to the Parquet fact dataset
+    if settings['parquet_dir']:
+        export_snapshot('dim_customer', dw_engine, settings['parquet_dir'], refresh=row_count > 0)
+
+    return row_count
+
+
+if __name__ == '__main__':
+    from etl import main
+    main(['dim_customer'])
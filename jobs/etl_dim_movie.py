@@ -1,78 +1,66 @@
-import pandas as pd
-import sqlalchemy as db
-import configparser
 import logging
-from logging.config import fileConfig
+from functools import partial
+from lazy import lazy_import
+from extract import stream_pages, read_source, limit_clause, select_list, extract_batches
+from joins import JoinStep, join_chain
+from refcache import lookup_reference
+from capture import Dimension, capture_source, staged_pending, capture_changes, write_changes
+from staging import run_staged, resume_staged
+from budget import batch_sizer, next_batch_size, run_measured
+from parquet_sink import export_snapshot
+from settings import resolve_settings
+
+pd = lazy_import('pandas')
 
-# Configs
-config = configparser.ConfigParser()
-config.read('conf/.env')
-
-fileConfig('conf/logging_config.ini')
 logger = logging.getLogger()
 
-# Database connection URI
-db_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['database']['user'],
-        config['database']['password'],
-        config['database']['host'],
-        config['database']['port'],
-        config['database']['db']
-    )
-)
-
-# Data warehouse connection URI
-dw_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['data-warehouse']['user'],
-        config['data-warehouse']['password'],
-        config['data-warehouse']['host'],
-        config['data-warehouse']['port'],
-        config['data-warehouse']['db']
-    )
-)
+# Columns consumed from each table, pushed down into the extract and lookup SELECTs
+COLUMNS = {
+    'film': ['film_id', 'title', 'description', 'release_year', 'language_id',
+             'rental_duration', 'length', 'rating', 'special_features'],
+    'language': ['language_id', 'name'],
+}
+
+# Join chain of `film` -> `language` and the dimension columns
+JOINS = [
+    JoinStep('language_id', 'language', 'language_id', {'name': 'language'}),
+]
+DIM_COLUMNS = ['film_id', 'title', 'description', 'release_year', 'language',
+               'rental_duration', 'length', 'rating', 'special_features']
+
+# Change capture of `dim_movie`, see `capture.py`. It keeps no versions, a
+# changed movie is overwritten
+DIMENSION = Dimension('dim_movie', 'film_id', DIM_COLUMNS)
 
 ############################################
 # FUNCTIONS
 ############################################
 
 
-def get_dimMovie_last_id(database):
-    """ Function to get last film_id from dimension table `dim_movie` """
-    query = "SELECT max(film_id) AS last_film_id FROM dim_movie"
-    tdf = pd.read_sql(query, database)
-    return tdf.iloc[0]['last_film_id']
-
-
-def extract_table_film(last_film_id, database):
+def extract_table_film(last_film_id, database, batch_size=100000, chunksize=None):
     """ Function to extract table `film` """
     if last_film_id == None:
         last_film_id = -1
 
-    query = "SELECT * FROM film WHERE film_id > {} LIMIT 100000".format(
-        last_film_id)
-    return pd.read_sql(query, database)
+    query = "SELECT {} FROM film WHERE film_id > {} ORDER BY film_id {}".format(
+        select_list(COLUMNS['film']), last_film_id, limit_clause(batch_size))
+    return read_source(query, 'film', database, chunksize=chunksize)
 
 
-def lookup_table_language(film_df, database):
-    """ Funstion to lookup table `language` """
-    unique_ids = list(film_df.language_id.unique())
-    unique_ids = list(filter(None, unique_ids))
+def stream_table_film(last_film_id, database, batch_size=100000):
+    """ Generator: extract table `film` page by page until the backlog is drained """
+    return stream_pages(extract_table_film, 'film_id', last_film_id, database, batch_size)
+
 
-    query = "SELECT * FROM language WHERE language_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
+def lookup_table_language(film_df, database, cache_dir=''):
+    """ Funstion to lookup table `language` """
+    return lookup_reference('language', 'language_id', film_df.language_id,
+                            database, cache_dir, COLUMNS['language'])
 
 
 def join_film_language(film_df, language_df):
     """ Transformation: join table `film` and `language` """
-    film_df = pd.merge(film_df, language_df, left_on='language_id',
-                       right_on='language_id', how='left')
-    film_df = film_df[['film_id', 'title', 'description', 'release_year',
-                       'name', 'rental_duration', 'length', 'rating', 'special_features']]
-    film_df = film_df.rename({'name': 'language'}, axis=1)
-    return film_df
+    return join_chain(film_df, JOINS, {'language': language_df}, DIM_COLUMNS)
 
 
 def validate(source_df, destination_df):
@@ -88,43 +76,89 @@ def validate(source_df, destination_df):
         )
 
 
-def load_dim_movie(destiantion_df):
-    """ Load to data warehouse """
-    destiantion_df.to_sql('dim_movie', dw_engine,
-                          if_exists='append', index=False)
+def transform_batch(film_df, engines, settings):
+    """ Lookup and transform one batch of `film` rows """
+    db_engine, dw_engine = engines
+    # The reference cache refreshes by `last_update`, a hash diff reads the source
+    cache_dir = settings['reference_cache_dir'] if settings['change_capture'] != 'hash' else ''
 
-############################################
-# EXTRACT
-############################################
+    # Extract lookup table `language`
+    language_df = lookup_table_language(film_df, db_engine, cache_dir)
 
+    # Join table `film` with `language`
+    dim_movie_df = join_film_language(film_df, language_df)
 
-# Get last film_id from dim_movie data warehouse
-last_film_id = get_dimMovie_last_id(dw_engine)
-logger.debug('last_film_id={}'.format(last_film_id))
+    # Validate result
+    dim_movie_df = validate(film_df, dim_movie_df)
 
-# Extract the store table into a pandas DataFrame
-film_df = extract_table_film(last_film_id, db_engine)
+    # Keep the new and changed movies
+    return capture_changes(dim_movie_df, film_df, DIMENSION, settings, dw_engine)
 
-# If no records fetched, then exit
-if film_df.shape[0] == 0:
-    raise Exception('No new record in source table')
 
-# Extract lookup table `language`
-language_df = lookup_table_language(film_df, db_engine)
+def write_batch(dim_movie_df, database, settings):
+    """ Update the changed movies in place, then load the new ones """
+    return write_changes(dim_movie_df, DIMENSION, settings, database)
 
-############################################
-# TRANSFORM
-############################################
-
-# Join table `film` with `language`
-dim_movie_df = join_film_language(film_df, language_df)
 
-# Validate result
-dim_movie_df = validate(film_df, dim_movie_df)
+def run_batch(film_df, engines, settings):
+    """ Transform and load one batch of `film` rows, checkpointed in the staging area """
+    return run_staged('dim_movie', film_df, 'film_id',
+                      partial(transform_batch, engines=engines, settings=settings),
+                      partial(write_batch, database=engines.dw_engine, settings=settings),
+                      settings['staging_dir'])
 
 ############################################
-# LOAD
+# RUN
 ############################################
 
-# Load dimension table `dim_movie`
-load_dim_movie(dim_movie_df)
+
+def run(engines, **overrides):
+    """ Run the job on the given engines, returns the number of loaded rows
+
+    Keyword arguments override the job settings, e.g. `batch_size=50000`.
+    """
+    settings = resolve_settings(overrides)
+    db_engine, dw_engine = engines
+
+    row_count = 0
+    if settings['staging_dir']:
+        # Finish the batches a failed run left in the staging area. Loads by
+        # id skip the rows already loaded, hashed batches are diffed again
+        row_count += resume_staged(
+            'dim_movie', partial(transform_batch, engines=engines, settings=settings),
+            partial(write_batch, database=dw_engine, settings=settings),
+            settings['staging_dir'], staged_pending(DIMENSION, settings, dw_engine))
+
+    # New rows by id, or without a trustworthy `last_update` the whole film
+    # table compared by row hash
+    last_film_id, extract, stream = capture_source(
+        DIMENSION, settings, dw_engine, (extract_table_film, stream_table_film))
+
+    # Extract the film table into pandas DataFrames, either one batch or
+    # keyset pages until the whole backlog is drained
+    sizer = batch_sizer('dim_movie', settings)
+    # A hash diff walks the whole table, in batch mode too
+    film_batches = extract_batches(settings['extract_mode'], extract, stream, last_film_id,
+                                   db_engine, settings['batch_size'], partial(next_batch_size, sizer),
+                                   pages=settings['change_capture'] == 'hash')
+
+    batch_count = 0
+    for film_df in film_batches:
+        # Stop at the first empty page
+        if film_df.shape[0] == 0:
+            break
+
+        row_count += run_measured(sizer, run_batch, film_df, engines, settings)
+        batch_count += 1
+        logger.debug('batch={} rows={}'.format(batch_count, film_df.shape[0]))
+
+    # Snapshot the dimension next to the Parquet fact dataset
+    if settings['parquet_dir']:
+        export_snapshot('dim_movie', dw_engine, settings['parquet_dir'], refresh=row_count > 0)
+
+    return row_count
+
+
+if __name__ == '__main__':
+    from etl import main
+    main(['dim_movie'])
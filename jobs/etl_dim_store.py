@@ -1,209 +1,276 @@
-import pandas as pd
-import sqlalchemy as db
-import configparser
 import logging
-from logging.config import fileConfig
+from functools import partial
+from lazy import lazy_import
+from extract import (stream_pages, stream_changes, changed_rows_condition, read_source,
+                     limit_clause, lookup_by_ids, run_lookup_graph, select_list, extract_batches)
+from joins import JoinStep, join_chain
+from refcache import lookup_reference
+from capture import (Dimension, capture_source, staged_pending, capture_changes, write_changes,
+                     advance_capture)
+from staging import run_staged, resume_staged
+from budget import batch_sizer, next_batch_size, run_measured
+from parquet_sink import export_snapshot
+from settings import resolve_settings
+
+pd = lazy_import('pandas')
 
-# Configs
-config = configparser.ConfigParser()
-config.read('conf/.env')
-
-fileConfig('conf/logging_config.ini')
 logger = logging.getLogger()
 
-# Database connection URI
-db_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['database']['user'],
-        config['database']['password'],
-        config['database']['host'],
-        config['database']['port'],
-        config['database']['db']
-    )
-)
-
-# Data warehouse connection URI
-dw_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['data-warehouse']['user'],
-        config['data-warehouse']['password'],
-        config['data-warehouse']['host'],
-        config['data-warehouse']['port'],
-        config['data-warehouse']['db']
-    )
-)
+# Columns consumed from each table, pushed down into the extract and lookup SELECTs
+COLUMNS = {
+    'store': ['store_id', 'manager_staff_id', 'address_id'],
+    'address': ['address_id', 'address', 'address2', 'district', 'city_id', 'postal_code'],
+    'city': ['city_id', 'city', 'country_id'],
+    'country': ['country_id', 'country'],
+    'staff': ['staff_id', 'first_name', 'last_name'],
+}
+
+# Join chain of `store` -> `address` -> `city` -> `country` and `store` -> `staff`
+# (the manager) and the dimension columns
+JOINS = [
+    JoinStep('address_id', 'address', 'address_id',
+             ['address', 'address2', 'district', 'city_id', 'postal_code']),
+    JoinStep('city_id', 'city', 'city_id', ['city', 'country_id']),
+    JoinStep('country_id', 'country', 'country_id', ['country']),
+    JoinStep('manager_staff_id', 'staff', 'staff_id',
+             {'first_name': 'manager_first_name', 'last_name': 'manager_last_name'}),
+]
+DIM_COLUMNS = ['store_id', 'address', 'address2', 'district', 'city', 'country',
+               'postal_code', 'manager_first_name', 'manager_last_name']
+
+# Start date of the first version of a store, older than any fact
+FIRST_START_DATE = '2005-01-01'
+
+# Change capture of `dim_store`, see `capture.py`
+DIMENSION = Dimension('dim_store', 'store_id', DIM_COLUMNS, FIRST_START_DATE)
 
 ############################################
 # FUNCTIONS
 ############################################
 
 
-def get_dimStore_last_id(database):
-    """ Function to get last_id in dim_store"""
-    query = "SELECT max(store_id) AS last_id FROM dim_store"
-    tdf = pd.read_sql(query, database)
-    return tdf.iloc[0]['last_id']
-
-
-def extract_table_store(last_id, database):
+def extract_table_store(last_id, database, batch_size=100000, chunksize=None):
     """ Function to extract table `store` """
     if last_id == None:
         last_id = -1
 
-    query = "SELECT * FROM store WHERE store_id > {} LIMIT 100000".format(
-        last_id)
-    return pd.read_sql(query, database)
+    query = "SELECT {} FROM store WHERE store_id > {} ORDER BY store_id {}".format(
+        select_list(COLUMNS['store']), last_id, limit_clause(batch_size))
+    return read_source(query, 'store', database, chunksize=chunksize)
 
 
-def lookup_table_address(store_df, database):
-    """ Function to lookup table `address`"""
-    unique_ids = list(store_df.address_id.unique())
-    unique_ids = list(filter(None, unique_ids))
+def stream_table_store(last_id, database, batch_size=100000):
+    """ Generator: extract table `store` page by page until the backlog is drained """
+    return stream_pages(extract_table_store, 'store_id', last_id, database, batch_size)
 
-    query = "SELECT * FROM address WHERE address_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
 
+def extract_changed_store(watermark, database, batch_size=100000, last_id=None, chunksize=None):
+    """ Function to extract the rows of table `store` updated since the watermark """
+    query = "SELECT {}, last_update FROM store WHERE {} ORDER BY last_update, store_id {}".format(
+        select_list(COLUMNS['store']), changed_rows_condition('store_id', watermark, last_id), limit_clause(batch_size))
+    return read_source(query, 'store', database, chunksize=chunksize)
 
-def lookup_table_city(address_df, database):
-    """ Function to lookup table `city` """
-    unique_ids = list(address_df.city_id.unique())
-    unique_ids = list(filter(None, unique_ids))
 
-    query = "SELECT * FROM city WHERE city_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
+def stream_changed_store(watermark, database, batch_size=100000, last_id=None):
+    """ Generator: extract changed rows page by page until the backlog is drained """
+    return stream_changes(extract_changed_store, 'store_id', watermark, database, batch_size, last_id)
 
 
-def lookup_table_country(city_df, databse):
-    """ Function to lookup table `country` """
-    unique_ids = list(city_df.country_id.unique())
-    unique_ids = list(filter(None, unique_ids))
+def extract_dim_store(last_id, database, batch_size=100000, chunksize=None):
+    """ Pushdown: extract table `store` joined with `address`, `city`, `country` and `staff` by the source """
+    if last_id == None:
+        last_id = -1
 
-    query = "SELECT * FROM country WHERE country_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, databse)
+    query = """
+        SELECT s.store_id, a.address, a.address2, a.district, ci.city,
+               co.country, a.postal_code, st.first_name AS manager_first_name,
+               st.last_name AS manager_last_name
+        FROM store s
+        LEFT JOIN address a ON a.address_id = s.address_id
+        LEFT JOIN city ci ON ci.city_id = a.city_id
+        LEFT JOIN country co ON co.country_id = ci.country_id
+        LEFT JOIN staff st ON st.staff_id = s.manager_staff_id
+        WHERE s.store_id > {} ORDER BY s.store_id {}
+    """.format(last_id, limit_clause(batch_size))
+    return read_source(query, 'store', database, chunksize=chunksize)
 
 
-def lookup_table_staff(store_df, database):
-    """ Function to lookup table `staff` """
-    unique_ids = list(store_df.manager_staff_id.unique())
-    unique_ids = list(filter(None, unique_ids))
-
-    query = "SELECT * FROM staff WHERE staff_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
-
-
-def join_store_address(store_df, address_df):
-    """ Transformation: join table `store` and `address` """
-    store_df = pd.merge(store_df, address_df,
-                        left_on='address_id', right_on='address_id', how='left')
-    store_df = store_df[['store_id', 'manager_staff_id', 'last_update_x',
-                         'address', 'address2', 'district', 'city_id', 'postal_code']]
-    return store_df
-
-
-def join_store_city(store_df, city_df):
-    """ Transformation: join table `store` and `city` """
-    store_df = pd.merge(store_df, city_df, left_on='city_id',
-                        right_on='city_id', how='left')
-    store_df = store_df[['store_id', 'manager_staff_id', 'last_update_x',
-                         'address', 'address2', 'district', 'city', 'country_id', 'postal_code']]
-    store_df = store_df.rename({'last_update_x': 'last_update'}, axis=1)
-    return store_df
-
-
-def join_store_country(store_df, country_df):
-    """ Transformation: join table `store` and `country` """
-    store_df = pd.merge(store_df, country_df,
-                        left_on='country_id', right_on='country_id', how='left')
-    store_df = store_df[['store_id', 'manager_staff_id', 'last_update_x',
-                         'address', 'address2', 'district', 'city', 'country', 'postal_code']]
-    store_df = store_df.rename({'last_update_x': 'last_update'}, axis=1)
-    return store_df
-
-
-def join_store_manager_staff(store_df, staff_df):
-    """ Transformation: join table `store` and `manager_staff` """
-    store_df = pd.merge(
-        store_df, staff_df, left_on='manager_staff_id', right_on='staff_id', how='left')
-    store_df = store_df[['store_id_x', 'address', 'address2', 'district',
-                         'city', 'country', 'postal_code', 'first_name', 'last_name']]
-    store_df = store_df.rename(
-        {'store_id_x': 'store_id', 'first_name': 'manager_first_name', 'last_name': 'manager_last_name'}, axis=1)
-    return store_df
-
-
-def validate(source_df, destination_df):
-    """ Function to validate transformation result """
-    source_row_count = source_df.shape[0]
-    destination_row_count = destination_df.shape[0]
+def stream_dim_store(last_id, database, batch_size=100000):
+    """ Generator: pushdown extract page by page until the backlog is drained """
+    return stream_pages(extract_dim_store, 'store_id', last_id, database, batch_size)
 
-    if(source_row_count == destination_row_count):
-        return destination_df
-    else:
-        raise ValueError(
-            'Transformation result is not valid: row count is not equal')
 
+def lookup_table_store(dim_store_df, database):
+    """ Function to lookup table `store` """
+    return lookup_by_ids('store', 'store_id', dim_store_df.store_id,
+                         database, COLUMNS['store'])
 
-def load_dim_store(destination_df):
-    destination_df.to_sql('dim_store', dw_engine,
-                          if_exists='append', index=False)
 
-############################################
-# EXTRACT
-############################################
+def lookup_table_address(store_df, database, cache_dir=''):
+    """ Function to lookup table `address`"""
+    return lookup_reference('address', 'address_id', store_df.address_id,
+                            database, cache_dir, COLUMNS['address'])
 
 
-# Get last customer_id from dim_customer data warehouse
-last_id = get_dimStore_last_id(dw_engine)
-logger.debug('last_id={}'.format(last_id))
+def lookup_table_city(address_df, database, cache_dir=''):
+    """ Function to lookup table `city` """
+    return lookup_reference('city', 'city_id', address_df.city_id,
+                            database, cache_dir, COLUMNS['city'])
 
-# Extract the store table into a pandas DataFrame
-store_df = extract_table_store(last_id, db_engine)
 
-# If no records, then exit
-if store_df.shape[0] == 0:
-    raise Exception('No new record in source table')
+def lookup_table_country(city_df, databse, cache_dir=''):
+    """ Function to lookup table `country` """
+    return lookup_reference('country', 'country_id', city_df.country_id,
+                            databse, cache_dir, COLUMNS['country'])
 
-# Extract lookup table `address`
-address_df = lookup_table_address(store_df, db_engine)
 
-# Extract lookup table `city`
-city_df = lookup_table_city(address_df, db_engine)
+def lookup_table_staff(store_df, database, cache_dir=''):
+    """ Function to lookup table `staff` """
+    return lookup_reference('staff', 'staff_id', store_df.manager_staff_id,
+                            database, cache_dir, COLUMNS['staff'])
 
-# Extract lookup table `country`
-country_df = lookup_table_country(city_df, db_engine)
 
-# Extract lookup table `staff`
-staff_df = lookup_table_staff(store_df, db_engine)
+def join_store_lookups(store_df, lookups):
+    """ Transformation: join table `store` with `address`, `city`, `country` and `staff` """
+    return join_chain(store_df, JOINS, lookups, DIM_COLUMNS)
 
-############################################
-# TRANSFORM
-############################################
 
-# Join table `store` with `address`
-dim_store_df = join_store_address(store_df, address_df)
+def validate(source_df, destination_df, expected_df=None):
+    """ Function to validate transformation result """
+    source_row_count = source_df.shape[0]
+    destination_row_count = destination_df.shape[0]
 
-# Join table `store` with `city`
-dim_store_df = join_store_city(dim_store_df, city_df)
+    if(source_row_count != destination_row_count):
+        raise ValueError(
+            'Transformation result is not valid: row count is not equal')
+
+    # Make sure the pushdown join returns the same rows as the pandas merges
+    if expected_df is not None:
+        try:
+            pd.testing.assert_frame_equal(
+                destination_df[expected_df.columns].sort_values('store_id').reset_index(drop=True),
+                expected_df.sort_values('store_id').reset_index(drop=True),
+                check_dtype=False, check_categorical=False)
+        except AssertionError as error:
+            raise ValueError(
+                'Transformation result is not valid: pushdown join differs from pandas merge\n{}'.format(error))
+    return destination_df
+
+
+def merge_store_address_chain(store_df, database, cache_dir, max_workers=4):
+    """ Lookup `address`, `city`, `country` and `staff` and join them to `store` in pandas """
+    # Extract lookup tables, `staff` runs concurrently with the
+    # `address` -> `city` -> `country` chain
+    lookups = run_lookup_graph({
+        'address': (lookup_table_address, ['store'], database, cache_dir),
+        'city': (lookup_table_city, ['address'], database, cache_dir),
+        'country': (lookup_table_country, ['city'], database, cache_dir),
+        'staff': (lookup_table_staff, ['store'], database, cache_dir),
+    }, {'store': store_df}, max_workers)
+
+    # Join table `store` with `address`, `city`, `country` and `staff`
+    return join_store_lookups(store_df, lookups)
+
+
+def transform_batch(store_df, engines, settings):
+    """ Lookup and transform one batch of `store` rows """
+    db_engine, dw_engine = engines
+    # The reference cache refreshes by `last_update`, a hash diff reads the source
+    cache_dir = settings['reference_cache_dir'] if settings['change_capture'] != 'hash' else ''
+
+    expected_df = None
+    if settings['join_pushdown'] and settings['change_capture'] in ('id', 'hash'):
+        # The source database already joined `address`, `city`, `country` and `staff`
+        dim_store_df = store_df.copy()
+        if settings['validate_pushdown']:
+            expected_df = merge_store_address_chain(
+                lookup_table_store(store_df, db_engine), db_engine, cache_dir,
+                settings['lookup_workers'])
+    else:
+        dim_store_df = merge_store_address_chain(
+            store_df, db_engine, cache_dir, settings['lookup_workers'])
+
+    # Validate result
+    dim_store_df = validate(store_df, dim_store_df, expected_df)
+    logger.debug('dim_store_df=\n{}'.format(dim_store_df.dtypes))
 
-# Join table `store` with `country`
-dim_store_df = join_store_country(dim_store_df, country_df)
+    # Keep the new and changed stores
+    return capture_changes(dim_store_df, store_df, DIMENSION, settings, dw_engine)
 
-# Join table `store` with `staff`
-dim_store_df = join_store_manager_staff(dim_store_df, staff_df)
 
-# Add start_date column
-dim_store_df['start_date'] = '2005-01-01'
+def write_batch(dim_store_df, database, settings):
+    """ Record the rows the batch only baselines, then load the others """
+    return write_changes(dim_store_df, DIMENSION, settings, database)
+
+
+def run_batch(store_df, engines, settings):
+    """ Transform and load one batch of `store` rows, checkpointed in the staging area """
+    row_count = run_staged('dim_store', store_df, 'store_id',
+                           partial(transform_batch, engines=engines, settings=settings),
+                           partial(write_batch, database=engines.dw_engine, settings=settings),
+                           settings['staging_dir'])
+
+    # The whole page is captured, whatever rows it wrote
+    advance_capture(store_df, DIMENSION, settings, engines.dw_engine)
+    return row_count
 
-# Validate result
-dim_store_df = validate(store_df, dim_store_df)
-logger.debug('dim_store_df=\n{}'.format(dim_store_df.dtypes))
 ############################################
-# LOAD
+# RUN
 ############################################
 
-# Load dimension table `dim_store` to data warehouse
-load_dim_store(dim_store_df)
+
+def run(engines, **overrides):
+    """ Run the job on the given engines, returns the number of loaded rows
+
+    Keyword arguments override the job settings, e.g. `batch_size=50000`.
+    """
+    settings = resolve_settings(overrides)
+    db_engine, dw_engine = engines
+
+    row_count = 0
+    if settings['staging_dir']:
+        # Finish the batches a failed run left in the staging area. Loads by
+        # id skip the rows already loaded, versioned batches are transformed
+        # again since their versions depend on the warehouse
+        row_count += resume_staged(
+            'dim_store', partial(transform_batch, engines=engines, settings=settings),
+            partial(write_batch, database=dw_engine, settings=settings),
+            settings['staging_dir'], staged_pending(DIMENSION, settings, dw_engine))
+
+    # Rows changed since the last captured `last_update`, new rows by id, or
+    # without a trustworthy `last_update` the whole store table compared by
+    # row hash. Loads by id read the store table, or with pushdown the store
+    # table already joined by the source database
+    last_id, extract, stream = capture_source(
+        DIMENSION, settings, dw_engine, (extract_table_store, stream_table_store),
+        (extract_changed_store, stream_changed_store), (extract_dim_store, stream_dim_store))
+
+    # Extract into pandas DataFrames, either one batch or keyset pages until
+    # the whole backlog is drained
+    sizer = batch_sizer('dim_store', settings)
+    # A hash diff walks the whole table, in batch mode too
+    store_batches = extract_batches(settings['extract_mode'], extract, stream, last_id, db_engine,
+                                    settings['batch_size'], partial(next_batch_size, sizer),
+                                    pages=settings['change_capture'] == 'hash')
+
+    batch_count = 0
+    for store_df in store_batches:
+        # Stop at the first empty page
+        if store_df.shape[0] == 0:
+            break
+
+        # Already captured changes are skipped, count the loaded rows
+        row_count += run_measured(sizer, run_batch, store_df, engines, settings)
+        batch_count += 1
+        logger.debug('batch={} rows={}'.format(batch_count, store_df.shape[0]))
+
+    # Snapshot the dimension next to the Parquet fact dataset
+    if settings['parquet_dir']:
+        export_snapshot('dim_store', dw_engine, settings['parquet_dir'], refresh=row_count > 0)
+
+    return row_count
+
+
+if __name__ == '__main__':
+    from etl import main
+    main(['dim_store'])
@@ -1,37 +1,50 @@
-import pandas as pd
-import sqlalchemy as db
-import configparser
+import sys
 import logging
-from logging.config import fileConfig
+from concurrent.futures import ProcessPoolExecutor, wait
+from functools import partial
+from multiprocessing import get_context
+from lazy import lazy_import
+from engines import Engines, engine_factory
+from extract import (stream_pages, read_source, limit_clause, lookup_by_ids,
+                     run_lookup_graph, select_list, extract_batches)
+from loader import load_dataframe
+from joins import JoinStep, join_chain
+from watermark import read_watermark, write_watermark, advance_watermark
+from staging import run_staged, resume_staged, not_loaded
+from budget import batch_sizer, next_batch_size, run_measured
+from aggregates import reconcile_aggregates, fold_aggregates, fold_sales
+from parquet_sink import fact_sink
+from settings import resolve_settings
+import metrics
+
+pd = lazy_import('pandas')
 
-# Configs
-config = configparser.ConfigParser()
-config.read('conf/.env')
-
-fileConfig('conf/logging_config.ini')
 logger = logging.getLogger()
 
-# Database connection URI
-db_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['database']['user'],
-        config['database']['password'],
-        config['database']['host'],
-        config['database']['port'],
-        config['database']['db']
-    )
-)
-
-# Data warehouse connection URI
-dw_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['data-warehouse']['user'],
-        config['data-warehouse']['password'],
-        config['data-warehouse']['host'],
-        config['data-warehouse']['port'],
-        config['data-warehouse']['db']
-    )
-)
+# Columns consumed from each table, pushed down into the extract and lookup SELECTs
+COLUMNS = {
+    'payment': ['payment_id', 'customer_id', 'rental_id', 'amount', 'payment_date'],
+    'rental': ['rental_id', 'inventory_id'],
+    'inventory': ['inventory_id', 'film_id', 'store_id'],
+    'dim_customer': ['customer_key', 'customer_id', 'start_date', 'end_date'],
+    'dim_movie': ['movie_key', 'film_id'],
+    'dim_store': ['store_key', 'store_id', 'start_date', 'end_date'],
+}
+
+# Join chain of `payment`: the customer and store versions active at the
+# payment date, `rental` -> `inventory` -> `dim_movie` for the movie
+JOINS = [
+    JoinStep('customer_id', 'dim_customer', 'customer_id', ['customer_key'], as_of='payment_date'),
+    JoinStep('rental_id', 'rental', 'rental_id', ['inventory_id']),
+    JoinStep('inventory_id', 'inventory', 'inventory_id', ['film_id', 'store_id']),
+    JoinStep('film_id', 'dim_movie', 'film_id', ['movie_key']),
+    JoinStep('store_id', 'dim_store', 'store_id', ['store_key'], as_of='payment_date'),
+]
+JOINED_COLUMNS = ['payment_id', 'customer_key', 'movie_key', 'store_key', 'amount', 'payment_date']
+
+# Watermark job of a partitioned run that didn't finish: the last payment_id
+# of its ranges, rows up to it may be loaded past the `fact_sales` watermark
+PARTITIONED_JOB = 'fact_sales:partitioned'
 
 ############################################
 # FUNCTIONS
@@ -39,134 +52,102 @@ dw_engine = db.create_engine(
 
 
 def get_factSales_last_id(database):
-    """ Function to get last sales_key from fact table `fact_sales` """
+    """ Function to get last sales_key loaded in fact table `fact_sales` """
+    watermark = read_watermark('fact_sales', database)
+    if watermark is not None:
+        return watermark['last_id']
+
+    # Warehouses loaded before the watermark control table: scan the table
     query = "SELECT max(sales_key) AS last_id FROM fact_sales"
     tdf = pd.read_sql(query, database)
     return tdf.iloc[0]['last_id']
 
 
-def extract_table_payment(last_id, database):
-    """ Function to extract table `payment` """
-    if last_id == None:
-        last_id = -1
-
-    query = "SELECT * FROM payment WHERE payment_id > {} LIMIT 100000".format(
-        last_id)
-    return pd.read_sql(query, database)
-
-
-def lookup_dim_customer(payment_df, database):
-    """ Function to lookup table `dim_customer` """
-    unique_ids = list(payment_df.customer_id.unique())
-    unique_ids = list(filter(None, unique_ids))
-
-    query = "SELECT * FROM dim_customer WHERE customer_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
+def get_partitioned_last_id(database):
+    """ Function to get the last payment_id of a pending partitioned run, None when there is none """
+    watermark = read_watermark(PARTITIONED_JOB, database)
+    if watermark is not None:
+        return watermark['last_id']
+    return None
 
 
-def lookup_table_rental(payment_df, database):
-    """ Function to lookup table `rental` """
-    payment_df = payment_df.dropna(how='any', subset=['rental_id'])
-    unique_ids = list(payment_df.rental_id.unique())
-
-    query = "SELECT * FROM rental WHERE rental_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
+def extract_table_payment(last_id, database, batch_size=100000, backend='pandas', chunksize=None,
+                          to_id=None):
+    """ Function to extract table `payment`, up to payment_id `to_id` when given """
+    if last_id == None:
+        last_id = -1
 
+    condition = "payment_id > {}".format(last_id)
+    if to_id is not None:
+        condition += " AND payment_id <= {}".format(to_id)
 
-def lookup_table_inventory(rental_df, database):
-    """ Function to lookup table `Inventory` """
-    rental_df = rental_df.dropna(how='any', subset=['inventory_id'])
-    unique_ids = list(rental_df.inventory_id.unique())
+    query = "SELECT {} FROM payment WHERE {} ORDER BY payment_id {}".format(
+        select_list(COLUMNS['payment']), condition, limit_clause(batch_size))
+    return read_source(query, 'payment', database, backend, chunksize)
 
-    query = "SELECT * FROM inventory WHERE inventory_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
 
+def stream_table_payment(last_id, database, batch_size=100000, backend='pandas'):
+    """ Generator: extract table `payment` page by page until the backlog is drained """
+    return stream_pages(partial(extract_table_payment, backend=backend),
+                        'payment_id', last_id, database, batch_size)
 
-def lookup_dim_movie(inventory_df, database):
-    """ Function to lookup table `dim_movie` """
-    inventory_df = inventory_df.dropna(how='any', subset=['film_id'])
-    unique_ids = list(inventory_df.film_id.unique())
 
-    query = "SELECT * FROM dim_movie WHERE film_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
+def get_payment_id_range(last_id, database):
+    """ First and last payment_id after `last_id`, None when there is no new payment """
+    query = "SELECT min(payment_id) AS first_id, max(payment_id) AS last_id FROM payment WHERE payment_id > {}".format(
+        -1 if last_id is None or pd.isnull(last_id) else last_id)
+    tdf = pd.read_sql(query, database)
+    if pd.isnull(tdf.iloc[0]['first_id']):
+        return None
+    return int(tdf.iloc[0]['first_id']), int(tdf.iloc[0]['last_id'])
 
 
-def lookup_dim_store(inventory_df, database):
-    """ Function to lookup table `dim_store` """
-    inventory_df = inventory_df.dropna(how='any', subset=['store_id'])
-    unique_ids = list(inventory_df.store_id.unique())
+def partition_ranges(first_id, last_id, partitions):
+    """ Split the ids from `first_id` to `last_id` into at most `partitions` disjoint (after, to] ranges """
+    step = -(-(last_id - first_id + 1) // partitions)
+    return [(start - 1, min(start + step - 1, last_id))
+            for start in range(first_id, last_id + 1, step)]
 
-    query = "SELECT * FROM dim_store WHERE store_id IN ({})".format(
-        ','.join(map(str, unique_ids)))
-    return pd.read_sql(query, database)
 
+def lookup_dim_customer(payment_df, database, backend='pandas'):
+    """ Function to lookup table `dim_customer` """
+    return lookup_by_ids('dim_customer', 'customer_id', payment_df.customer_id,
+                         database, COLUMNS['dim_customer'], backend)
 
-def join_payment_dim_customer(payment_df, dim_customer_df):
-    """ Transform: join table payment and dim_customer """
-    payment_df = pd.merge(payment_df, dim_customer_df,
-                          left_on='customer_id', right_on='customer_id', how='left')
-    payment_df = payment_df[['payment_id', 'customer_key', 'customer_id',
-                             'rental_id', 'amount', 'payment_date', 'start_date', 'end_date']]
-    payment_df = payment_df.rename({
-        'start_date': 'customer_start_date',
-        'end_date': 'customer_end_date'
-    }, axis=1)
-    # make sure we only join wiht customer record that's active at the time of transaction date
-    payment_df = payment_df[(pd.to_datetime(payment_df.customer_start_date) <= payment_df.payment_date) & (
-        (pd.to_datetime(payment_df.customer_end_date) >= payment_df.payment_date) | (payment_df.customer_end_date.isnull()))]
 
-    return payment_df
+def lookup_table_rental(payment_df, database, backend='pandas'):
+    """ Function to lookup table `rental` """
+    return lookup_by_ids('rental', 'rental_id', payment_df.rental_id,
+                         database, COLUMNS['rental'], backend)
 
 
-def join_payment_rental(payment_df, rental_df):
-    """ Transformation: join table `payment` and `rental` """
-    payment_df = pd.merge(payment_df, rental_df,
-                          left_on='rental_id', right_on='rental_id', how='left')
-    payment_df = payment_df[['payment_id', 'customer_key',
-                             'inventory_id', 'amount', 'payment_date', ]]
-    return payment_df
+def lookup_table_inventory(rental_df, database, backend='pandas'):
+    """ Function to lookup table `Inventory` """
+    return lookup_by_ids('inventory', 'inventory_id', rental_df.inventory_id,
+                         database, COLUMNS['inventory'], backend)
 
 
-def join_payment_inventory(payment_df, inventory_df):
-    """ Transformation: join table `payment` and `inventory` """
-    payment_df = pd.merge(payment_df, inventory_df,
-                          left_on='inventory_id', right_on='inventory_id', how='left')
-    payment_df = payment_df[['payment_id', 'customer_key',
-                             'film_id', 'store_id', 'amount', 'payment_date', ]]
-    return payment_df
+def lookup_dim_movie(inventory_df, database, backend='pandas'):
+    """ Function to lookup table `dim_movie` """
+    return lookup_by_ids('dim_movie', 'film_id', inventory_df.film_id,
+                         database, COLUMNS['dim_movie'], backend)
 
 
-def join_payment_dim_movie(payment_df, dim_movie_df):
-    """ Transformation: join table `payment` and `dim_movie` """
-    payment_df = pd.merge(payment_df, dim_movie_df,
-                          left_on='film_id', right_on='film_id', how='left')
-    payment_df = payment_df[['payment_id', 'customer_key',
-                             'movie_key', 'store_id', 'amount', 'payment_date', ]]
-    return payment_df
+def lookup_dim_store(inventory_df, database, backend='pandas'):
+    """ Function to lookup table `dim_store` """
+    return lookup_by_ids('dim_store', 'store_id', inventory_df.store_id,
+                         database, COLUMNS['dim_store'], backend)
 
 
-def join_payment_dim_store(payment_df, dim_store_df):
-    """ Transformation: join table `payment` and `dim_store` """
-    payment_df = pd.merge(payment_df, dim_store_df,
-                          left_on='store_id', right_on='store_id', how='left')
-    payment_df = payment_df[['payment_id', 'customer_key', 'movie_key',
-                             'store_key', 'amount', 'payment_date', 'start_date', 'end_date']]
-    payment_df = payment_df.rename(
-        {'start_date': 'store_start_date', 'end_date': 'store_end_date'}, axis=1)
-    # Make sure we only join with store record that is active at the time of transaction_date
-    payment_df = payment_df[(pd.to_datetime(payment_df.store_start_date) <= payment_df.payment_date)
-                            & ((pd.to_datetime(payment_df.store_end_date) >= payment_df.payment_date) | (payment_df.store_end_date.isnull()))
-                            | (payment_df.store_key.isnull())]
-    return payment_df
+def join_payment_lookups(payment_df, lookups):
+    """ Transformation: join table `payment` with its lookups, see JOINS """
+    return join_chain(payment_df, JOINS, lookups, JOINED_COLUMNS)
 
 
 def add_date_key(payment_df):
     """ Add date_key smart key """
-    payment_df['date_key'] = payment_df.payment_date.dt.strftime('%Y%m%d')
+    payment_date = payment_df.payment_date.dt
+    payment_df['date_key'] = payment_date.year * 10000 + payment_date.month * 100 + payment_date.day
     return payment_df
 
 
@@ -199,81 +180,250 @@ def validate(source_df, destination_df):
     return destination_df
 
 
-def load_dim_payment(destination_df):
-    """ Load to data warehouse """
-    destination_df.to_sql('fact_sales', dw_engine,
-                          if_exists='append', index=False)
-
-############################################
-# EXTRACT
-############################################
-
-
-# Get last id from fact_sales data warehouse
-last_id = get_factSales_last_id(dw_engine)
-logger.debug('last_id={}'.format(last_id))
-
-# Extract the payment table into a pandas DataFrame
-payment_df = extract_table_payment(last_id, db_engine)
-
-# If no records fetched, then exit
-if payment_df.shape[0] == 0:
-    raise Exception('No new record in source table')
-
-# Extract lookup table `customer`
-dim_customer_df = lookup_dim_customer(payment_df, dw_engine)
-
-# Extract lookup table `rental`
-rental_df = lookup_table_rental(payment_df, db_engine)
+def sales_sinks(settings, fold=True):
+    """ Load callbacks of the loaded sales: daily summary tables and Parquet export, when enabled
+
+    Without `fold` the chunks aren't added to the summary tables, their
+    sales are folded once the watermark passes them, see `fold_sales`.
+    """
+    sinks = []
+    if settings['sales_aggregates'] and fold:
+        sinks.append(fold_aggregates)
+    if settings['parquet_dir']:
+        sinks.append(fact_sink(settings['parquet_dir'], 'fact_sales', 'sales_key'))
+    return sinks
+
+
+def load_dim_payment(destination_df, database, settings):
+    """ Load to data warehouse, advancing the watermark with each chunk
+
+    After a failed partitioned run, rows up to its last payment_id may be
+    loaded past the watermark whatever the number of workers now: they are
+    skipped, then the watermark moves past the batch together with the
+    summary tables, and the pending run is cleared once the watermark
+    reaches its last payment_id.
+    """
+    partitioned_id = get_partitioned_last_id(database)
+    if partitioned_id is None or destination_df.shape[0] == 0 or destination_df.sales_key.min() > partitioned_id:
+        return load_dataframe(destination_df, 'fact_sales', database,
+                              settings['load_strategy'], settings['load_chunksize'],
+                              advance_watermark('fact_sales', 'sales_key'), sales_sinks(settings))
+
+    row_count = load_partition(destination_df, database, settings)
+    last_id = destination_df.sales_key.max()
+    with database.begin() as connection:
+        write_watermark(connection, 'fact_sales', last_id)
+        if settings['sales_aggregates']:
+            fold_sales(connection, last_id)
+        if last_id >= partitioned_id:
+            write_watermark(connection, PARTITIONED_JOB)
+    return row_count
+
+
+def lookup_fact_sales_keys(destination_df, database):
+    """ Function to lookup the sales_key of `destination_df` already loaded in `fact_sales` """
+    query = "SELECT sales_key FROM fact_sales WHERE sales_key BETWEEN {} AND {}".format(
+        destination_df.sales_key.min(), destination_df.sales_key.max())
+    return pd.read_sql(query, database)
 
-# Extract lookup table `inventory`
-inventory_df = lookup_table_inventory(rental_df, db_engine)
 
-# Extract lookup table `dim_movie`
-dim_movie_df = lookup_dim_movie(inventory_df, dw_engine)
+def load_partition(destination_df, database, settings):
+    """ Load the rows of a partition that aren't loaded yet, without advancing the watermark
+
+    A failed partitioned run leaves the rows of its finished partitions
+    after the watermark, they are skipped when the run is retried. Rows
+    past the watermark aren't folded into the summary tables yet.
+    """
+    if destination_df.shape[0] > 0:
+        loaded_df = lookup_fact_sales_keys(destination_df, database)
+        destination_df = destination_df[~destination_df.sales_key.isin(loaded_df.sales_key)]
+    return load_dataframe(destination_df, 'fact_sales', database,
+                          settings['load_strategy'], settings['load_chunksize'],
+                          sinks=sales_sinks(settings, fold=False))
+
+
+def transform_batch(payment_df, engines, settings):
+    """ Lookup and transform one batch of `payment` rows """
+    db_engine, dw_engine = engines
+
+    ############################################
+    # EXTRACT
+    ############################################
+
+    # Extract lookup tables, independent lookups run concurrently:
+    # `dim_customer` and `rental` first, `inventory` after `rental`,
+    # then `dim_movie` and `dim_store` after `inventory`
+    backend = settings['extract_backend']
+    lookups = run_lookup_graph({
+        'dim_customer': (lookup_dim_customer, ['payment'], dw_engine, backend),
+        'rental': (lookup_table_rental, ['payment'], db_engine, backend),
+        'inventory': (lookup_table_inventory, ['rental'], db_engine, backend),
+        'dim_movie': (lookup_dim_movie, ['inventory'], dw_engine, backend),
+        'dim_store': (lookup_dim_store, ['inventory'], dw_engine, backend),
+    }, {'payment': payment_df}, settings['lookup_workers'])
+
+    ############################################
+    # TRANSFORM
+    ############################################
+
+    # Join table `payment` with `dim_customer`, `rental`, `inventory`,
+    # `dim_movie` and `dim_store`
+    dim_payment_df = join_payment_lookups(payment_df, lookups)
+    logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
+
+    # Add date_key smart_key
+    dim_payment_df = add_date_key(dim_payment_df)
+    logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
+
+    # Rename and remove
+    dim_payment_df = rename_remove_columns(dim_payment_df)
+    logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
+
+    # Validate result
+    dim_payment_df = validate(payment_df, dim_payment_df)
+    logger.debug('dim_payment_df=\n{}'.format(dim_payment_df.dtypes))
+    return dim_payment_df
+
+
+def batch_loader(engines, settings):
+    """ Load function of the batches: partitions load without advancing the watermark """
+    load = load_partition if settings['partition_workers'] > 1 else load_dim_payment
+    return partial(load, database=engines.dw_engine, settings=settings)
+
+
+def run_batch(payment_df, engines, settings):
+    """ Transform and load one batch of `payment` rows, checkpointed in the staging area """
+    return run_staged('fact_sales', payment_df, 'payment_id',
+                      partial(transform_batch, engines=engines, settings=settings),
+                      batch_loader(engines, settings), settings['staging_dir'])
+
+
+def run_partition(after_id, to_id, factories, settings, instrumented):
+    """ Worker process: load the payments after `after_id` up to `to_id`
+
+    The range is drained in keyset pages of batch_size rows, or read
+    through a server-side cursor in `cursor` extract mode. Returns the
+    loaded row count and the stage metrics of the worker.
+    """
+    engines = Engines(*(factory() for factory in factories))
+    if instrumented:
+        metrics.instrument(sys.modules[__name__], 'fact_sales')
+
+    extract = partial(extract_table_payment, backend=settings['extract_backend'], to_id=to_id)
+    sizer = batch_sizer('fact_sales', settings)
+    # The range is drained in keyset pages, in batch mode too
+    payment_batches = extract_batches(settings['extract_mode'], extract, partial(stream_pages, extract, 'payment_id'),
+                                      after_id, engines.db_engine, settings['batch_size'],
+                                      partial(next_batch_size, sizer), pages=True)
+
+    row_count = 0
+    for payment_df in payment_batches:
+        if payment_df.shape[0] == 0:
+            break
+        row_count += run_measured(sizer, run_batch, payment_df, engines, settings)
+    logger.info('partition after_id={} to_id={} rows={}'.format(after_id, to_id, row_count))
+    return row_count, metrics.job_stages('fact_sales')
+
+
+def run_partitions(last_id, engines, settings):
+    """ Load the whole backlog in disjoint payment_id ranges, each in its own worker process
+
+    Workers open their own connections and load their range in order,
+    the watermark is advanced past the backlog only once every partition
+    is loaded. When a partition fails, the watermark stays where it was
+    and the run stays pending in PARTITIONED_JOB: the retried run, with
+    or without partitions, skips the rows the other partitions loaded.
+    The summary tables fold the whole backlog with the watermark.
+    """
+    id_range = get_payment_id_range(last_id, engines.db_engine)
+    if id_range is None:
+        return 0
+
+    ranges = partition_ranges(*id_range, settings['partition_workers'])
+    factories = [engine_factory(engine) for engine in engines]
+
+    # Until every partition is loaded, any retried run skips the loaded rows
+    with engines.dw_engine.begin() as connection:
+        write_watermark(connection, PARTITIONED_JOB, ranges[-1][1])
+    instrumented = getattr(sys.modules[__name__], 'instrumented', False)
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=get_context('spawn')) as pool:
+        futures = [pool.submit(run_partition, after_id, to_id, factories, settings, instrumented)
+                   for after_id, to_id in ranges]
+        wait(futures)
+
+    row_count = 0
+    for future in futures:
+        # The first failed partition is raised, before the watermark moves
+        partition_rows, stages = future.result()
+        row_count += partition_rows
+        metrics.merge_stages(stages)
+
+    with engines.dw_engine.begin() as connection:
+        write_watermark(connection, 'fact_sales', ranges[-1][1])
+        if settings['sales_aggregates']:
+            fold_sales(connection, ranges[-1][1])
+        write_watermark(connection, PARTITIONED_JOB)
+    return row_count
 
-# Extract lookup table `dim_store`
-dim_store_df = lookup_dim_store(inventory_df, dw_engine)
 
 ############################################
-# TRANSFORM
+# RUN
 ############################################
 
-# Join table `payment` & `dim_customer`
-dim_payment_df = join_payment_dim_customer(payment_df, dim_customer_df)
-logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
-
-# Join table `payment` & `rental`
-dim_payment_df = join_payment_rental(dim_payment_df, rental_df)
-logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
-
-# Join table `payment` & `inventory`
-dim_payment_df = join_payment_inventory(dim_payment_df, inventory_df)
-logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
-
-# Join table `payment` & `dim_movie`
-dim_payment_df = join_payment_dim_movie(dim_payment_df, dim_movie_df)
-logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
-
-# Join table `payment` & `dim_store`
-dim_payment_df = join_payment_dim_store(dim_payment_df, dim_store_df)
-logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
-
-# Add date_key smart_key
-dim_payment_df = add_date_key(dim_payment_df)
-logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
-
-# Rename and remove
-dim_payment_df = rename_remove_columns(dim_payment_df)
-logger.debug('dim_payment_df=\n{}'.format(dim_payment_df))
-
-# Validate result
-dim_payment_df = validate(payment_df, dim_payment_df)
-logger.debug('dim_payment_df=\n{}'.format(dim_payment_df.dtypes))
-
-############################################
-# LOAD
-############################################
 
-# Load dimension table `fact_sales`
-load_dim_payment(dim_payment_df)
+def run(engines, **overrides):
+    """ Run the job on the given engines, returns the number of loaded rows
+
+    Keyword arguments override the job settings, e.g. `batch_size=50000`.
+    """
+    settings = resolve_settings(overrides)
+    db_engine, dw_engine = engines
+
+    if settings['sales_aggregates']:
+        # Fold the sales loaded while the summary tables were off
+        reconcile_aggregates(dw_engine, get_factSales_last_id(dw_engine))
+
+    row_count = 0
+    if settings['staging_dir']:
+        # Finish the batches a failed run left in the staging area, the rows
+        # it already loaded are skipped
+        pending = not_loaded('sales_key', get_factSales_last_id(dw_engine))
+        if settings['partition_workers'] > 1:
+            # Partitions load past the watermark, their loads skip loaded rows
+            pending = not_loaded('sales_key', None)
+        row_count += resume_staged(
+            'fact_sales', partial(transform_batch, engines=engines, settings=settings),
+            batch_loader(engines, settings), settings['staging_dir'], pending)
+
+    # Get last id from fact_sales data warehouse
+    last_id = get_factSales_last_id(dw_engine)
+    logger.debug('last_id={}'.format(last_id))
+
+    # Backfill the whole backlog in worker processes, one payment_id range each
+    if settings['partition_workers'] > 1:
+        return row_count + run_partitions(last_id, engines, settings)
+
+    # Extract the payment table into pandas DataFrames, either one batch or
+    # keyset pages until the whole backlog is drained
+    sizer = batch_sizer('fact_sales', settings)
+    backend = settings['extract_backend']
+    payment_batches = extract_batches(settings['extract_mode'], partial(extract_table_payment, backend=backend),
+                                      partial(stream_table_payment, backend=backend), last_id, db_engine,
+                                      settings['batch_size'], partial(next_batch_size, sizer))
+
+    batch_count = 0
+    for payment_df in payment_batches:
+        # Stop at the first empty page
+        if payment_df.shape[0] == 0:
+            break
+
+        row_count += run_measured(sizer, run_batch, payment_df, engines, settings)
+        batch_count += 1
+        logger.debug('batch={} rows={}'.format(batch_count, payment_df.shape[0]))
+
+    return row_count
+
+
+if __name__ == '__main__':
+    from etl import main
+    main(['fact_sales'])
@@ -0,0 +1,384 @@
+import os
+import importlib.util
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import lru_cache
+from lazy import lazy_import
+from schema import apply_schema
+
+pa = lazy_import('pyarrow')
+cx = lazy_import('connectorx')
+pd = lazy_import('pandas')
+db = lazy_import('sqlalchemy')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED EXTRACT HELPERS
+############################################
+
+
+# Rows fetched per Arrow record batch by the `arrow` backend
+ARROW_BATCH_ROWS = 10000
+
+READ_BACKENDS = ['pandas', 'arrow']
+
+# How the jobs read their backlog, see `extract_batches`
+EXTRACT_MODES = ['batch', 'stream', 'cursor']
+
+# Dialects connectorx reads straight into Arrow buffers
+CONNECTORX_DIALECTS = ['mysql', 'sqlite', 'postgresql']
+
+# Queries of a list connectorx runs concurrently, each on its own connection
+CONNECTORX_QUERIES = 4
+
+# An id lookup reads the whole id range in one query when the range holds
+# at most RANGE_SPAN times as many ids as the lookup, IN lists otherwise
+RANGE_SPAN = 4
+
+
+@lru_cache(maxsize=None)
+def has_connectorx():
+    """ Whether the optional connectorx package is installed """
+    return importlib.util.find_spec('connectorx') is not None
+
+
+def connectorx_uri(database):
+    """ connectorx connection string of an engine, None when connectorx can't read it """
+    if not isinstance(database, db.engine.Engine) or not has_connectorx():
+        return None
+
+    url = database.url
+    dialect = url.get_backend_name()
+    if dialect not in CONNECTORX_DIALECTS:
+        return None
+    if dialect == 'sqlite':
+        if not url.database or url.database == ':memory:':
+            return None
+        return 'sqlite://{}'.format(os.path.abspath(url.database))
+    return url.set(drivername=dialect, query={}).render_as_string(hide_password=False)
+
+
+def concat_arrow_chunks(chunks):
+    """ One Arrow array of the chunks of a column, cast to the widest type of the chunks
+
+    Each chunk infers its type from its own values: a chunk without a value
+    is null-typed, and DECIMAL values get the precision of the chunk (e.g.
+    decimal128(3, 2) up to 9.99, decimal128(4, 2) with 11.99).
+    """
+    column_type = pa.unify_schemas(
+        [pa.schema([('column', c.type)]) for c in chunks], promote_options='permissive').field('column').type
+    return pa.chunked_array([c.cast(column_type) for c in chunks], column_type)
+
+
+@lru_cache(maxsize=None)
+def nullable_dtypes():
+    """ Nullable pandas dtypes of the Arrow integer and boolean types """
+    return {
+        pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(),
+        pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype(),
+        pa.uint8(): pd.UInt8Dtype(), pa.uint16(): pd.UInt16Dtype(),
+        pa.uint32(): pd.UInt32Dtype(), pa.uint64(): pd.UInt64Dtype(),
+        pa.bool_(): pd.BooleanDtype(),
+    }
+
+
+def arrow_to_pandas(table):
+    """ DataFrame of an Arrow table, one buffer copy per column and no Python object per value
+
+    Integer and boolean columns become nullable dtypes, so a NULL doesn't
+    turn them into float or object columns. The frame is numpy-backed: the
+    joins, SCD2 lookups and loads downstream would convert Arrow-backed
+    columns back on every batch.
+    """
+    return table.to_pandas(types_mapper=nullable_dtypes().get)
+
+
+def arrow_frame(names, partitions):
+    """ DataFrame of lists of rows, built column by column through Arrow arrays """
+    columns = [[] for _ in names]
+    for rows in partitions:
+        for chunks, values in zip(columns, zip(*rows)):
+            chunks.append(pa.array(values))
+
+    return arrow_to_pandas(pa.Table.from_arrays([concat_arrow_chunks(c) for c in columns], names=list(names)))
+
+
+def read_arrow_cursor(query, database):
+    """ Read a query result into a DataFrame through the DBAPI cursor and Arrow arrays
+
+    Rows are fetched ARROW_BATCH_ROWS at a time and turned into Arrow
+    arrays, without the object-dtype frame `pd.read_sql` builds first.
+    """
+    if isinstance(database, db.engine.Engine):
+        with database.connect() as connection:
+            return read_arrow_cursor(query, connection)
+
+    result = database.exec_driver_sql(query)
+    return arrow_frame(result.keys(), result.partitions(ARROW_BATCH_ROWS))
+
+
+def read_arrow(query, database):
+    """ Read a query result, or a list of queries with the same columns, through Arrow
+
+    On an engine connectorx can read, the driver writes the results into
+    Arrow buffers directly, without a Python object per row or value, and
+    runs a list of queries concurrently. Otherwise, e.g. on a connection
+    holding a temp table, or for results connectorx can't convert like
+    SQLite text that doesn't match its declared type, the rows are read
+    through the cursor, see `read_arrow_cursor`.
+    """
+    uri = connectorx_uri(database)
+    if uri is not None:
+        try:
+            if not isinstance(query, list):
+                return arrow_to_pandas(cx.read_sql(uri, query, return_type='arrow'))
+            return arrow_to_pandas(pa.concat_tables([
+                cx.read_sql(uri, query[start:start + CONNECTORX_QUERIES], return_type='arrow')
+                for start in range(0, len(query), CONNECTORX_QUERIES)]))
+        except RuntimeError as error:
+            logger.debug('connectorx read failed, reading through the cursor: {}'.format(error))
+
+    if isinstance(query, list):
+        return pd.concat([read_arrow_cursor(q, database) for q in query], ignore_index=True)
+    return read_arrow_cursor(query, database)
+
+
+def read_frame(query, database, backend='pandas'):
+    """ Read a query result with one of READ_BACKENDS, on an engine or a connection """
+    if backend == 'arrow':
+        return read_arrow(query, database)
+    if backend != 'pandas':
+        raise ValueError('Unknown read backend: {} (expected one of {})'.format(
+            backend, ', '.join(READ_BACKENDS)))
+    return pd.read_sql(query, database)
+
+
+def stream_cursor(query, database, chunksize, backend='pandas'):
+    """ Generator: read one query in frames of `chunksize` rows through a server-side cursor
+
+    The driver fetches rows as the frames are consumed instead of buffering
+    the whole result first (an unbuffered SSCursor with pymysql), so memory
+    stays at one frame whatever the result size and the first frame is
+    transformed while the source still sends the rest. The connection is
+    held until the generator is exhausted or closed.
+    """
+    with database.connect() as connection:
+        connection = connection.execution_options(stream_results=True, max_row_buffer=chunksize)
+        if backend == 'arrow':
+            result = connection.exec_driver_sql(query)
+            for rows in result.partitions(chunksize):
+                yield arrow_frame(result.keys(), [rows])
+        else:
+            for chunk_df in pd.read_sql(query, connection, chunksize=chunksize):
+                yield chunk_df
+
+
+def read_source(query, table, database, backend='pandas', chunksize=None):
+    """ Read a source query and apply the schema of `table`
+
+    Returns one frame, or with `chunksize` a generator of frames read
+    through a server-side cursor, see `stream_cursor`.
+    """
+    if chunksize:
+        return (apply_schema(chunk_df, table)
+                for chunk_df in stream_cursor(query, database, chunksize, backend))
+    return apply_schema(read_frame(query, database, backend), table)
+
+
+def limit_clause(batch_size):
+    """ `LIMIT` of a batch query, none when `batch_size` is None and the whole backlog is read """
+    return '' if batch_size is None else 'LIMIT {}'.format(batch_size)
+
+
+def page_size(batch_size):
+    """ Rows of the next page, `batch_size` may be a function, see budget.next_batch_size """
+    return batch_size() if callable(batch_size) else batch_size
+
+
+def stream_pages(extract, key, last_id, database, batch_size):
+    """ Generator: walk a source table in keyset pages of `key` > last seen id
+
+    `extract` is one of the job's `extract_table_*` functions. Each page is
+    yielded before the next one is fetched, so the caller can lookup,
+    transform and load it with only one page held in memory. `batch_size`
+    is a row count or a function returning the rows of the next page.
+    """
+    while True:
+        page_df = extract(last_id, database, page_size(batch_size))
+        if page_df.shape[0] == 0:
+            return
+        yield page_df
+        last_id = page_df[key].max()
+
+
+def changed_rows_condition(key, watermark, last_id=None):
+    """ WHERE condition of the rows changed since `watermark`, after (`watermark`, `last_id`)
+
+    Without a last seen id the rows updated at the watermark itself are
+    included, a second with several updates may have been loaded only in
+    part. All rows match when there is no watermark yet.
+    """
+    if watermark is None or pd.isnull(watermark):
+        if last_id is None:
+            return '1 = 1'
+        return '{} > {}'.format(key, last_id)
+
+    # With microseconds, as SQLAlchemy stores DateTime values on SQLite, where
+    # the comparison is between strings
+    watermark = pd.Timestamp(watermark).strftime('%Y-%m-%d %H:%M:%S.%f')
+    if last_id is None:
+        return "last_update >= '{}'".format(watermark)
+    return "(last_update > '{0}' OR (last_update = '{0}' AND {1} > {2}))".format(
+        watermark, key, last_id)
+
+
+def stream_changes(extract, key, watermark, database, batch_size, last_id=None):
+    """ Generator: walk the rows changed since `watermark` in keyset pages of (`last_update`, `key`)
+
+    `extract` is one of the job's `extract_changed_*` functions, called
+    with the watermark and the last seen id of the previous page, the
+    first page starts after `last_id` when given. `batch_size` is the same
+    as for `stream_pages`.
+    """
+    while True:
+        page_df = extract(watermark, database, page_size(batch_size), last_id)
+        if page_df.shape[0] == 0:
+            return
+        yield page_df
+        watermark, last_id = page_df['last_update'].iloc[-1], page_df[key].iloc[-1]
+
+
+def extract_batches(extract_mode, extract, stream, last_id, database, batch_size, next_size=None, pages=False):
+    """ Frames of the backlog after `last_id` in one of EXTRACT_MODES
+
+    `batch` is one batch of `batch_size` rows, `stream` keyset pages until
+    the backlog is drained, of `next_size()` rows when given, and `cursor`
+    the whole backlog in one query without LIMIT, read through a
+    server-side cursor in frames of `batch_size` rows. `extract` and
+    `stream` are the job's `extract_*` and `stream_*` functions. With
+    `pages`, batch mode walks keyset pages too, e.g. for a hash diff of the
+    whole table.
+    """
+    if extract_mode not in EXTRACT_MODES:
+        raise ValueError('Unknown extract mode: {} (expected one of {})'.format(
+            extract_mode, ', '.join(EXTRACT_MODES)))
+    if extract_mode == 'stream' or (pages and extract_mode == 'batch'):
+        return stream(last_id, database, next_size or batch_size)
+    if extract_mode == 'cursor':
+        return extract(last_id, database, None, chunksize=batch_size)
+    return [extract(last_id, database, batch_size)]
+
+
+# Ids per `IN (...)` list before the lookup is split into several queries
+IN_LIST_SIZE = 1000
+
+# Id count from which a lookup goes through a session temp table and JOIN
+TEMP_TABLE_THRESHOLD = 20000
+
+
+def select_list(columns, alias=None):
+    """ SELECT list of the projected columns, `*` when no projection is given """
+    prefix = '{}.'.format(alias) if alias else ''
+    if columns is None:
+        return prefix + '*'
+    return ', '.join(prefix + column for column in columns)
+
+
+def unique_ids(ids):
+    """ Distinct non-null ids of a Series or list, as Python ints """
+    return pd.Series(ids).dropna().drop_duplicates().to_numpy(dtype='int64').tolist()
+
+
+def in_list_queries(table, key, ids, columns=None):
+    """ SELECTs of the rows of `table` whose `key` is in `ids`, IN_LIST_SIZE ids each """
+    return ["SELECT {} FROM {} WHERE {} IN ({})".format(
+        select_list(columns), table, key, ','.join(map(str, ids[start:start + IN_LIST_SIZE])))
+        for start in range(0, len(ids), IN_LIST_SIZE)]
+
+
+def lookup_by_ids(table, key, ids, database, columns=None, backend='pandas'):
+    """ Lookup `columns` (all when None) of the rows of `table` whose `key` is in `ids`
+
+    The strategy is picked from the id count: an empty set returns an empty
+    frame, built without a round-trip when `columns` are given, up to
+    TEMP_TABLE_THRESHOLD ids are sent as IN lists of at most IN_LIST_SIZE
+    ids, larger sets are joined through a session temp table. `backend` is the read backend, see `read_frame`;
+    with `arrow` and connectorx, dense ids are read as one id range and
+    sparse ones as IN lists, without a temp table.
+    """
+    ids = unique_ids(ids)
+
+    if len(ids) == 0:
+        if columns is not None:
+            return apply_schema(pd.DataFrame(columns=list(columns)), table)
+        # Only the table knows its columns
+        query = "SELECT {} FROM {} LIMIT 0".format(select_list(columns), table)
+        return apply_schema(read_frame(query, database, backend), table)
+
+    if backend == 'arrow' and connectorx_uri(database) is not None:
+        first_id, last_id = min(ids), max(ids)
+        if last_id - first_id < RANGE_SPAN * len(ids):
+            # Dense ids: one range read, the rows of other ids are dropped in Arrow
+            query = "SELECT {} FROM {} WHERE {} BETWEEN {} AND {}".format(
+                select_list(columns), table, key, first_id, last_id)
+            range_df = read_arrow(query, database)
+            range_df = range_df[range_df[key].isin(ids)].reset_index(drop=True)
+            return apply_schema(range_df, table)
+        # connectorx runs the IN lists concurrently into one Arrow table,
+        # whatever the id count, without a temp table
+        return apply_schema(read_arrow(in_list_queries(table, key, ids, columns), database), table)
+
+    if len(ids) < TEMP_TABLE_THRESHOLD:
+        lookup_dfs = [read_frame(query, database, backend)
+                      for query in in_list_queries(table, key, ids, columns)]
+        return apply_schema(pd.concat(lookup_dfs, ignore_index=True), table)
+
+    # Temp tables are per session, so everything runs on one connection
+    with database.connect() as connection:
+        connection.exec_driver_sql(
+            "CREATE TEMPORARY TABLE lookup_ids (id BIGINT NOT NULL PRIMARY KEY)")
+        try:
+            insert = db.text("INSERT INTO lookup_ids (id) VALUES (:id)")
+            for start in range(0, len(ids), IN_LIST_SIZE * 10):
+                connection.execute(
+                    insert, [{'id': i} for i in ids[start:start + IN_LIST_SIZE * 10]])
+            query = "SELECT {} FROM {} t JOIN lookup_ids l ON t.{} = l.id".format(
+                select_list(columns, 't'), table, key)
+            return apply_schema(read_frame(query, connection, backend), table)
+        finally:
+            connection.exec_driver_sql("DROP TABLE lookup_ids")
+            connection.commit()
+
+
+def run_lookup_graph(lookups, inputs, max_workers):
+    """ Run a dependency graph of lookups on a thread pool
+
+    `lookups` maps a name to `(function, dependencies, *arguments)`; the
+    function is called with the results of its dependencies followed by the
+    arguments, as soon as all of them are available. `inputs` seeds the
+    results with frames that are already extracted. Independent lookups
+    overlap their round-trips, each on its own pooled connection, so the
+    wall-clock falls to the critical path. Returns all results by name.
+    """
+    results = dict(inputs)
+    pending = dict(lookups)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name, (function, dependencies, *arguments) in list(pending.items()):
+                if all(d in results for d in dependencies):
+                    arguments = [results[d] for d in dependencies] + arguments
+                    running[pool.submit(function, *arguments)] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError('Lookup graph has unresolvable dependencies: {}'.format(
+                    ', '.join(pending)))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results
@@ -1,38 +1,13 @@
-import pandas as pd
-import sqlalchemy as db
-import configparser
 import logging
-from logging.config import fileConfig
+from lazy import lazy_import
+from loader import load_dataframe
+from parquet_sink import export_snapshot
+from settings import resolve_settings
 
-# Configs
-config = configparser.ConfigParser()
-config.read('conf/.env')
+pd = lazy_import('pandas')
 
-fileConfig('conf/logging_config.ini')
 logger = logging.getLogger()
 
-# Database connection URI
-db_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['database']['user'],
-        config['database']['password'],
-        config['database']['host'],
-        config['database']['port'],
-        config['database']['db']
-    )
-)
-
-# Data warehouse connection URI
-dw_engine = db.create_engine(
-    "mysql+pymysql://{}:{}@{}:{}/{}".format(
-        config['data-warehouse']['user'],
-        config['data-warehouse']['password'],
-        config['data-warehouse']['host'],
-        config['data-warehouse']['port'],
-        config['data-warehouse']['db']
-    )
-)
-
 
 def extract_latest_date(db_engine, table, field):
     """ Get the latest date from a table """
@@ -41,48 +16,82 @@ def extract_latest_date(db_engine, table, field):
     return result_df.loc[0, 'max_date']
 
 
-def label_weekend(row):
-    """ Add label `1` for weekend or `0` for weekday """
-    if row['dayofweek'] == 5 or row['dayofweek'] == 6:
-        return 1
-    else:
-        return 0
+def holiday_dates(calendar_name, start, end):
+    """ Holidays between start and end from a pandas holiday calendar
+
+    `calendar_name` is any registered `AbstractHolidayCalendar` subclass,
+    e.g. `USFederalHolidayCalendar` or a custom calendar defined before the
+    job runs. An empty name means no holidays.
+    """
+    if not calendar_name:
+        return pd.DatetimeIndex([])
 
+    from pandas.tseries.holiday import get_calendar
+    return get_calendar(calendar_name).holidays(start, end)
 
-def create_date_table(start, end):
+
+def create_date_table(start, end, holiday_calendar=''):
     """ Generate date records for a range of date """
-    df = pd.DataFrame({"date": pd.date_range(start, end)})
-    df["dayofweek"] = df.date.dt.dayofweek
-    df["day"] = df.date.dt.day
-    df["week"] = df.date.dt.weekofyear
-    df["month"] = df.date.dt.month
-    df["quarter"] = df.date.dt.quarter
-    df["year"] = df.date.dt.year
-    df["is_weekend"] = df.apply(lambda row: label_weekend(row), axis=1)
-    df["is_holiday"] = df.apply(lambda row: label_weekend(row), axis=1)
-    df["date_key"] = df.date.dt.strftime('%Y%m%d')
-    return df[['date_key', 'day', 'date', 'year', 'quarter', 'month', 'week', 'is_weekend', 'is_holiday']]
-
-
-# Extract latest value from date dimension
-dateDim_latest = extract_latest_date(dw_engine, 'dim_date', 'date')
-
-# Determine start range of generated of
-if dateDim_latest == None:
-    start_date_range = pd.datetime(2005, 1, 1).date()
-else:
-    start_date_range = dateDim_latest + pd.Timedelta(1, unit='D')
-logger.debug('start_date_range={}'.format(start_date_range))
-
-# Determine and range of generated date
-end_date_range = pd.datetime(2006, 2, 16).date()
-logger.debug('end_date_range={}'.format(end_date_range))
-
-# Check if date range is valid
-if end_date_range >= start_date_range:
-    # Generate date range
-    date_range_df = create_date_table(start_date_range, end_date_range)
-    logger.debug('data_range_df={}'.format(date_range_df))
-
-    date_range_df.to_sql('dim_date', dw_engine,
-                         if_exists='append', index=False)
+    dates = pd.date_range(start, end)
+    df = pd.DataFrame({
+        "date_key": dates.year * 10000 + dates.month * 100 + dates.day,
+        "day": dates.day,
+        "date": dates,
+        "year": dates.year,
+        "quarter": dates.quarter,
+        "month": dates.month,
+        "week": dates.isocalendar().week.to_numpy(dtype='int64'),
+        "is_weekend": (dates.dayofweek >= 5).astype('int64'),
+        "is_holiday": dates.isin(holiday_dates(holiday_calendar, start, end)).astype('int64'),
+    })
+    return df
+
+
+def load_dim_date(date_range_df, database, settings):
+    """ Load to data warehouse """
+    return load_dataframe(date_range_df, 'dim_date', database,
+                          settings['load_strategy'], settings['load_chunksize'])
+
+
+def run(engines, **overrides):
+    """ Run the job on the given engines, returns the number of generated dates
+
+    Keyword arguments override the job settings, e.g. `load_strategy='multirow'`.
+    """
+    settings = resolve_settings(overrides)
+    db_engine, dw_engine = engines
+
+    # Extract latest value from date dimension
+    dateDim_latest = extract_latest_date(dw_engine, 'dim_date', 'date')
+
+    # Determine start range of generated of
+    if pd.isnull(dateDim_latest):
+        start_date_range = pd.Timestamp(settings['dim_date_start'])
+    else:
+        start_date_range = pd.Timestamp(dateDim_latest) + pd.Timedelta(1, unit='D')
+    logger.debug('start_date_range={}'.format(start_date_range))
+
+    # Determine and range of generated date
+    end_date_range = pd.Timestamp(settings['dim_date_end'])
+    logger.debug('end_date_range={}'.format(end_date_range))
+
+    # Check if date range is valid
+    row_count = 0
+    if end_date_range >= start_date_range:
+        # Generate date range
+        date_range_df = create_date_table(
+            start_date_range, end_date_range, settings['holiday_calendar'])
+        logger.debug('data_range_df={}'.format(date_range_df))
+
+        load_dim_date(date_range_df, dw_engine, settings)
+        row_count = date_range_df.shape[0]
+
+    # Snapshot the dimension next to the Parquet fact dataset
+    if settings['parquet_dir']:
+        export_snapshot('dim_date', dw_engine, settings['parquet_dir'], refresh=row_count > 0)
+    return row_count
+
+
+if __name__ == '__main__':
+    from etl import main
+    main(['dim_date'])
@@ -0,0 +1,242 @@
+import logging
+from lazy import lazy_import
+from watermark import watermark_table
+from aggregates import AGGREGATES, aggregate_table, build_table
+from row_hash import HASHED_DIMENSIONS, hash_table
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+db = lazy_import('sqlalchemy')
+
+logger = logging.getLogger()
+
+############################################
+# SYNTHETIC SAKILA DATA
+############################################
+
+# Row counts of the Sakila sample database, the 1x scale. Reference tables
+# keep their size at every scale, the others grow with it.
+SAKILA_ROWS = {
+    'country': 109, 'city': 600, 'language': 6, 'address': 603, 'staff': 2,
+    'store': 2, 'customer': 599, 'film': 1000, 'inventory': 4581,
+    'rental': 16044, 'payment': 16049,
+}
+FIXED_TABLES = ['country', 'city', 'language']
+
+# Rentals are spread over the Sakila rental period
+RENTAL_START = '2005-05-24'
+RENTAL_END = '2006-02-14'
+LAST_UPDATE = '2006-02-15 04:34:33'
+
+
+def source_metadata():
+    """ Tables of the Sakila source database read by the jobs """
+    metadata = db.MetaData()
+    integer, text, timestamp = db.Integer, db.String(255), db.DateTime
+
+    def table(name, *columns):
+        db.Table(name, metadata, *columns, db.Column('last_update', timestamp))
+
+    table('country', db.Column('country_id', integer, primary_key=True),
+          db.Column('country', text))
+    table('city', db.Column('city_id', integer, primary_key=True),
+          db.Column('city', text), db.Column('country_id', integer))
+    table('address', db.Column('address_id', integer, primary_key=True),
+          db.Column('address', text), db.Column('address2', text),
+          db.Column('district', text), db.Column('city_id', integer),
+          db.Column('postal_code', text), db.Column('phone', text))
+    table('language', db.Column('language_id', integer, primary_key=True),
+          db.Column('name', text))
+    table('staff', db.Column('staff_id', integer, primary_key=True),
+          db.Column('first_name', text), db.Column('last_name', text),
+          db.Column('address_id', integer), db.Column('email', text),
+          db.Column('store_id', integer), db.Column('active', integer),
+          db.Column('username', text))
+    table('store', db.Column('store_id', integer, primary_key=True),
+          db.Column('manager_staff_id', integer), db.Column('address_id', integer))
+    table('customer', db.Column('customer_id', integer, primary_key=True),
+          db.Column('store_id', integer), db.Column('first_name', text),
+          db.Column('last_name', text), db.Column('email', text),
+          db.Column('address_id', integer), db.Column('active', integer),
+          db.Column('create_date', timestamp))
+    table('film', db.Column('film_id', integer, primary_key=True),
+          db.Column('title', text), db.Column('description', text),
+          db.Column('release_year', integer), db.Column('language_id', integer),
+          db.Column('original_language_id', integer), db.Column('rental_duration', integer),
+          db.Column('rental_rate', db.Float), db.Column('length', integer),
+          db.Column('replacement_cost', db.Float), db.Column('rating', text),
+          db.Column('special_features', text))
+    table('inventory', db.Column('inventory_id', integer, primary_key=True),
+          db.Column('film_id', integer), db.Column('store_id', integer))
+    table('rental', db.Column('rental_id', integer, primary_key=True),
+          db.Column('rental_date', timestamp), db.Column('inventory_id', integer),
+          db.Column('customer_id', integer), db.Column('return_date', timestamp),
+          db.Column('staff_id', integer))
+    table('payment', db.Column('payment_id', integer, primary_key=True),
+          db.Column('customer_id', integer), db.Column('staff_id', integer),
+          db.Column('rental_id', integer), db.Column('amount', db.Float),
+          db.Column('payment_date', timestamp))
+    return metadata
+
+
+def warehouse_metadata():
+    """ Star schema of the data warehouse written by the jobs """
+    metadata = db.MetaData()
+    integer, text, timestamp = db.Integer, db.String(255), db.DateTime
+
+    db.Table('dim_customer', metadata,
+             db.Column('customer_key', integer, primary_key=True, autoincrement=True),
+             db.Column('customer_id', integer, index=True),
+             *[db.Column(c, text) for c in ['first_name', 'last_name', 'email', 'address',
+                                            'address2', 'district', 'city', 'country',
+                                            'postal_code', 'phone']],
+             db.Column('active', integer), db.Column('create_date', timestamp),
+             db.Column('start_date', timestamp), db.Column('end_date', timestamp),
+             db.Column('last_update', timestamp, index=True))
+    db.Table('dim_store', metadata,
+             db.Column('store_key', integer, primary_key=True, autoincrement=True),
+             db.Column('store_id', integer, index=True),
+             *[db.Column(c, text) for c in ['address', 'address2', 'district', 'city',
+                                            'country', 'postal_code', 'manager_first_name',
+                                            'manager_last_name']],
+             db.Column('start_date', timestamp), db.Column('end_date', timestamp),
+             db.Column('last_update', timestamp, index=True))
+    db.Table('dim_movie', metadata,
+             db.Column('movie_key', integer, primary_key=True, autoincrement=True),
+             db.Column('film_id', integer, index=True),
+             db.Column('title', text), db.Column('description', text),
+             db.Column('release_year', integer), db.Column('language', text),
+             db.Column('rental_duration', integer), db.Column('length', integer),
+             db.Column('rating', text), db.Column('special_features', text))
+    db.Table('dim_date', metadata,
+             db.Column('date_key', integer, primary_key=True, autoincrement=False),
+             db.Column('date', timestamp),
+             *[db.Column(c, integer) for c in ['year', 'quarter', 'month', 'day', 'week',
+                                               'is_weekend', 'is_holiday']])
+    db.Table('fact_sales', metadata,
+             db.Column('sales_key', integer, primary_key=True, autoincrement=False),
+             *[db.Column(c, integer) for c in ['date_key', 'customer_key', 'movie_key',
+                                               'store_key']],
+             db.Column('sales_amount', db.Float))
+    return metadata
+
+
+def labels(prefix, ids):
+    """ Vectorized `<prefix><id>` strings """
+    return prefix + pd.Series(ids).astype(str)
+
+
+def generate_sakila(scale=1, seed=0):
+    """ Generate the Sakila source tables at `scale` times their sample size
+
+    Foreign keys always reference existing rows and every rental has a
+    payment, a few payments have no rental like in Sakila. Returns a
+    DataFrame per table.
+    """
+    rng = np.random.default_rng(seed)
+    rows = {t: n if t in FIXED_TABLES else n * scale for t, n in SAKILA_ROWS.items()}
+
+    def ids(table):
+        return np.arange(1, rows[table] + 1)
+
+    def pick(table, size):
+        return rng.integers(1, rows[table] + 1, size)
+
+    tables = {}
+    tables['country'] = pd.DataFrame({'country_id': ids('country'),
+                                      'country': labels('Country ', ids('country'))})
+    tables['city'] = pd.DataFrame({'city_id': ids('city'), 'city': labels('City ', ids('city')),
+                                   'country_id': pick('country', rows['city'])})
+    tables['address'] = pd.DataFrame({
+        'address_id': ids('address'), 'address': labels('Street ', ids('address')),
+        'address2': None, 'district': labels('District ', rng.integers(1, 300, rows['address'])),
+        'city_id': pick('city', rows['address']),
+        'postal_code': pd.Series(rng.integers(10000, 99999, rows['address'])).astype(str),
+        'phone': pd.Series(rng.integers(10 ** 9, 10 ** 10, rows['address'])).astype(str),
+    })
+    tables['language'] = pd.DataFrame({'language_id': ids('language'),
+                                       'name': labels('Language ', ids('language'))})
+    tables['staff'] = pd.DataFrame({
+        'staff_id': ids('staff'), 'first_name': labels('Staff ', ids('staff')),
+        'last_name': labels('Member ', ids('staff')), 'address_id': pick('address', rows['staff']),
+        'email': labels('staff', ids('staff')) + '@sakilastaff.com', 'store_id': ids('store'),
+        'active': 1, 'username': labels('staff', ids('staff')),
+    })
+    tables['store'] = pd.DataFrame({'store_id': ids('store'), 'manager_staff_id': ids('staff'),
+                                    'address_id': pick('address', rows['store'])})
+    tables['customer'] = pd.DataFrame({
+        'customer_id': ids('customer'), 'store_id': pick('store', rows['customer']),
+        'first_name': labels('First ', ids('customer')), 'last_name': labels('Last ', ids('customer')),
+        'email': labels('customer', ids('customer')) + '@sakilacustomer.org',
+        'address_id': pick('address', rows['customer']),
+        'active': (rng.random(rows['customer']) > 0.03).astype(int),
+        'create_date': pd.Timestamp('2006-02-14 22:04:36'),
+    })
+    tables['film'] = pd.DataFrame({
+        'film_id': ids('film'), 'title': labels('FILM ', ids('film')),
+        'description': 'A synthetic film', 'release_year': 2006,
+        'language_id': pick('language', rows['film']), 'original_language_id': None,
+        'rental_duration': rng.integers(3, 8, rows['film']),
+        'rental_rate': rng.choice([0.99, 2.99, 4.99], rows['film']),
+        'length': rng.integers(46, 186, rows['film']),
+        'replacement_cost': rng.choice([9.99, 14.99, 19.99, 24.99], rows['film']),
+        'rating': rng.choice(['G', 'PG', 'PG-13', 'R', 'NC-17'], rows['film']),
+        'special_features': rng.choice(['Trailers', 'Commentaries', 'Deleted Scenes',
+                                        'Behind the Scenes'], rows['film']),
+    })
+    tables['inventory'] = pd.DataFrame({'inventory_id': ids('inventory'),
+                                        'film_id': pick('film', rows['inventory']),
+                                        'store_id': pick('store', rows['inventory'])})
+
+    start, end = pd.Timestamp(RENTAL_START), pd.Timestamp(RENTAL_END)
+    rental_dates = start + pd.to_timedelta(
+        np.sort(rng.integers(0, int((end - start).total_seconds()), rows['rental'])), unit='s')
+    tables['rental'] = pd.DataFrame({
+        'rental_id': ids('rental'), 'rental_date': rental_dates,
+        'inventory_id': pick('inventory', rows['rental']),
+        'customer_id': pick('customer', rows['rental']),
+        'return_date': rental_dates + pd.to_timedelta(rng.integers(1, 10, rows['rental']), unit='D'),
+        'staff_id': pick('staff', rows['rental']),
+    })
+
+    # One payment per rental, the extra payments have no rental
+    extra = rows['payment'] - rows['rental']
+    rental_df = tables['rental']
+    tables['payment'] = pd.DataFrame({
+        'payment_id': ids('payment'),
+        'customer_id': np.concatenate([rental_df.customer_id, pick('customer', extra)]),
+        'staff_id': np.concatenate([rental_df.staff_id, pick('staff', extra)]),
+        'rental_id': pd.Series(np.concatenate([rental_df.rental_id, np.zeros(extra, int)]),
+                               dtype='Int64').where(ids('payment') <= rows['rental']),
+        'amount': rng.choice([0.99, 1.99, 2.99, 3.99, 4.99, 5.99], rows['payment']),
+        'payment_date': np.concatenate([rental_df.rental_date.to_numpy(),
+                                        rental_dates[rows['rental'] - extra:].to_numpy()]),
+    })
+
+    for table_df in tables.values():
+        table_df['last_update'] = pd.Timestamp(LAST_UPDATE)
+    return tables
+
+
+def write_sakila(tables, database, chunksize=10000):
+    """ Create the Sakila source tables on `database` and fill them """
+    metadata = source_metadata()
+    metadata.drop_all(database)
+    metadata.create_all(database)
+
+    for table, table_df in tables.items():
+        table_df.to_sql(table, database, if_exists='append', index=False, chunksize=chunksize)
+        logger.info('generate table={} rows={}'.format(table, table_df.shape[0]))
+
+
+def create_warehouse(database):
+    """ Create an empty data warehouse on `database`, dropping the existing tables """
+    metadata = warehouse_metadata()
+    metadata.drop_all(database)
+    watermark_table().drop(database, checkfirst=True)
+    for table in AGGREGATES:
+        aggregate_table(table).drop(database, checkfirst=True)
+        build_table(table).drop(database, checkfirst=True)
+    for dimension, key in HASHED_DIMENSIONS.items():
+        hash_table(dimension, key).drop(database, checkfirst=True)
+    metadata.create_all(database)
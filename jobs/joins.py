@@ -0,0 +1,63 @@
+from collections import namedtuple
+from lazy import lazy_import
+from scd2 import build_scd2_index, resolve_scd2_key
+
+pd = lazy_import('pandas')
+
+############################################
+# SHARED DECLARATIVE JOIN CHAINS
+############################################
+
+# One left join of a chain: the rows of lookup frame `lookup` whose
+# `right_key` equals the `left_key` of each row fetch `columns`, a list of
+# names or a dict renaming them. With `as_of`, the lookup is an SCD2
+# dimension and the version active at the `as_of` date of the row is used.
+JoinStep = namedtuple('JoinStep', ['left_key', 'lookup', 'right_key', 'columns', 'as_of'],
+                      defaults=[None])
+
+
+def step_columns(step):
+    """ Fetched columns of a step and their output names """
+    if isinstance(step.columns, dict):
+        return step.columns
+    return {column: column for column in step.columns}
+
+
+def lookup_positions(lookup_df, right_key, keys):
+    """ Row of `lookup_df` matching each key, -1 where there is none
+
+    The lookup is indexed on its key once per step, every fetched column
+    is then taken at these positions without hashing the keys again.
+    """
+    lookup_df = lookup_df[lookup_df[right_key].notnull()].drop_duplicates(right_key)
+    return lookup_df, pd.Index(lookup_df[right_key]).get_indexer(keys)
+
+
+def join_chain(left_df, steps, lookups, columns):
+    """ Run a join chain on `left_df` and return its `columns`
+
+    Columns are kept as Series from step to step and the result frame is
+    built once at the end, there is no merge and no reprojected copy of the
+    whole frame per join. Each step is a left join: rows without a match
+    get missing values and the row count never changes.
+    """
+    series = {column: left_df[column] for column in left_df.columns}
+    for step in steps:
+        lookup_df = lookups[step.lookup]
+        fetched = step_columns(step)
+
+        if step.as_of is not None:
+            # One surrogate key, resolved as of the date of the row
+            (surrogate_key, name), = fetched.items()
+            index_df = build_scd2_index(lookup_df, step.right_key, surrogate_key)
+            keys_df = pd.DataFrame({step.right_key: series[step.left_key],
+                                    step.as_of: series[step.as_of]})
+            series[name] = resolve_scd2_key(keys_df, index_df, step.right_key, surrogate_key, step.as_of)
+            continue
+
+        lookup_df, positions = lookup_positions(lookup_df, step.right_key, series[step.left_key])
+        for column, name in fetched.items():
+            series[name] = pd.Series(lookup_df[column].array.take(positions, allow_fill=True),
+                                     index=left_df.index)
+
+    return pd.DataFrame({column: series[column] for column in columns}, index=left_df.index)
@@ -0,0 +1,22 @@
+import importlib
+import types
+
+############################################
+# LAZY IMPORTS
+############################################
+
+
+class LazyModule(types.ModuleType):
+    """ Module placeholder that imports the real module on first attribute access """
+
+    def __getattr__(self, attribute):
+        # import_module holds the per-module import lock, so concurrent
+        # first accesses from job threads import the module only once
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    """ Defer a heavy import (pandas, sqlalchemy, ...) until it is first used """
+    return LazyModule(name)
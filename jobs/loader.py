@@ -0,0 +1,156 @@
+import csv
+import os
+import tempfile
+import time
+import logging
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+db = lazy_import('sqlalchemy')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED LOAD STRATEGIES
+############################################
+
+# Characters that must be escaped for LOAD DATA with the default
+# `FIELDS ESCAPED BY '\\'` and no enclosing quotes
+INFILE_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\0': '\\0',
+})
+
+
+def escape_infile_value(value):
+    """ Escape one string value for a tab separated LOAD DATA file """
+    if isinstance(value, str):
+        return value.translate(INFILE_ESCAPES)
+    return value
+
+
+def frame_records(destination_df):
+    """ Convert a DataFrame to DBAPI rows of plain Python values, NULL for NaN/NaT """
+    columns = []
+    for column in destination_df.columns:
+        series = destination_df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            values = np.array(series.dt.to_pydatetime(), dtype=object)
+        else:
+            values = series.to_numpy(dtype=object)
+        columns.append(np.where(series.isnull().to_numpy(), None, values).tolist())
+
+    names = list(destination_df.columns)
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def load_to_sql(chunk_df, table, connection):
+    """ Strategy `to_sql`: pandas default row by row insert """
+    chunk_df.to_sql(table, connection, if_exists='append', index=False)
+
+
+def load_multirow(chunk_df, table, connection):
+    """ Strategy `multirow`: pandas `INSERT ... VALUES (...), (...)` per chunk """
+    chunk_df.to_sql(table, connection, if_exists='append', index=False, method='multi')
+
+
+def load_executemany(chunk_df, table, connection):
+    """ Strategy `executemany`: one DBAPI executemany per chunk of rows
+
+    pymysql rewrites an executemany `INSERT ... VALUES` into multi-row
+    statements, so each chunk costs a handful of round-trips.
+    """
+    statement = db.insert(
+        db.table(table, *[db.column(c) for c in chunk_df.columns]))
+    connection.execute(statement, frame_records(chunk_df))
+
+
+def load_infile(chunk_df, table, connection):
+    """ Strategy `infile`: `LOAD DATA LOCAL INFILE` from a temporary file per chunk
+
+    Needs `local_infile` enabled on both the MySQL server and the engine.
+    """
+    chunk_df = chunk_df.copy()
+    for column in chunk_df.select_dtypes(include=['object', 'string', 'category', 'bool']).columns:
+        if chunk_df[column].dtype == bool:
+            chunk_df[column] = chunk_df[column].astype(int)
+        else:
+            chunk_df[column] = chunk_df[column].map(
+                escape_infile_value, na_action='ignore')
+
+    query = ("LOAD DATA LOCAL INFILE '{}' INTO TABLE {} "
+             "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({})")
+    columns = ','.join('`{}`'.format(c) for c in chunk_df.columns)
+
+    handle, path = tempfile.mkstemp(suffix='.tsv')
+    os.close(handle)
+    try:
+        chunk_df.to_csv(path, sep='\t', header=False, index=False, na_rep='\\N',
+                        quoting=csv.QUOTE_NONE, lineterminator='\n')
+        connection.exec_driver_sql(query.format(path.replace('\\', '/'), table, columns))
+    finally:
+        os.remove(path)
+
+
+LOAD_STRATEGIES = {
+    'to_sql': load_to_sql,
+    'multirow': load_multirow,
+    'executemany': load_executemany,
+    'infile': load_infile,
+}
+
+
+def load_dataframe(destination_df, table, database, strategy='to_sql', chunksize=10000, watermark=None,
+                   sinks=(), pre_load=()):
+    """ Append a DataFrame to a warehouse table with the given load strategy
+
+    Every chunk of `chunksize` rows is committed in its own transaction,
+    together with `watermark(connection, chunk_df)` when given, so a crash
+    loses at most one chunk and the watermark never runs ahead of the
+    loaded rows. Each of `sinks(connection, chunk_df)` also gets the chunk
+    in that transaction, e.g. to fold it into summary tables or export it,
+    and each of `pre_load(connection, chunk_df)` before its rows are
+    inserted, e.g. to close the versions they replace.
+    Logs rows/sec so the fastest strategy can be picked for each table.
+    """
+    if strategy not in LOAD_STRATEGIES:
+        raise ValueError('Unknown load strategy: {} (expected one of {})'.format(
+            strategy, ', '.join(LOAD_STRATEGIES)))
+
+    row_count = destination_df.shape[0]
+    start_time = time.perf_counter()
+    for start in range(0, row_count, chunksize):
+        chunk_df = destination_df.iloc[start:start + chunksize]
+        with database.begin() as connection:
+            for callback in pre_load:
+                callback(connection, chunk_df)
+            LOAD_STRATEGIES[strategy](chunk_df, table, connection)
+            if watermark is not None:
+                watermark(connection, chunk_df)
+            for sink in sinks:
+                sink(connection, chunk_df)
+    elapsed = time.perf_counter() - start_time
+
+    logger.info('load table={} strategy={} chunksize={} rows={} seconds={:.3f} rows_per_sec={:.0f}'.format(
+        table, strategy, chunksize, row_count, elapsed, row_count / elapsed if elapsed > 0 else 0))
+    return row_count
+
+
+def update_dataframe(destination_df, table, key, connection):
+    """ Overwrite the rows of a warehouse table whose `key` matches a row of the DataFrame
+
+    One DBAPI executemany UPDATE on `connection`, inside the caller's
+    transaction, for tables updated in place instead of versioned.
+    """
+    if destination_df.shape[0] == 0:
+        return 0
+
+    columns = [c for c in destination_df.columns if c != key]
+    statement = db.text("UPDATE {} SET {} WHERE {} = :{}".format(
+        table, ', '.join('{0} = :{0}'.format(c) for c in columns), key, key))
+    connection.execute(statement, frame_records(destination_df))
+    return destination_df.shape[0]
@@ -0,0 +1,242 @@
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import logging
+from lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED STAGE AND JOB METRICS
+############################################
+
+# Stage kind of the job functions instrumented, by name prefix
+STAGE_KINDS = (
+    ('extract_', 'extract'),
+    ('lookup_', 'lookup'),
+    ('join_', 'transform'),
+    ('merge_', 'transform'),
+    ('add_', 'transform'),
+    ('rename_', 'transform'),
+    ('validate', 'transform'),
+    ('create_', 'transform'),
+    ('load_', 'load'),
+)
+
+# Metrics of this run, by (job, stage) and by job
+stage_metrics = {}
+job_metrics = {}
+metrics_lock = threading.Lock()
+
+
+def peak_rss_bytes():
+    """ Peak resident set size of this process, None where it can't be read """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss_bytes():
+    """ Resident set size of this process now, the peak where it can't be read """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_bytes()
+
+
+def frame_rows(value):
+    """ Row count of a DataFrame or Series, None for other values """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.shape[0]
+    return None
+
+
+def stage_kind(name):
+    """ Stage kind of a job function name, None when it isn't a stage """
+    for prefix, kind in STAGE_KINDS:
+        if name.startswith(prefix):
+            return kind
+    return None
+
+
+def record_stage(job, stage, kind, seconds, rows_in, rows_out, fetched_bytes):
+    """ Add one call of a stage to the run metrics """
+    with metrics_lock:
+        metric = stage_metrics.setdefault((job, stage), {
+            'job': job, 'stage': stage, 'kind': kind, 'calls': 0, 'seconds': 0.0,
+            'rows_in': 0, 'rows_out': 0, 'bytes': 0, 'peak_rss_bytes': None,
+        })
+        metric['calls'] += 1
+        metric['seconds'] += seconds
+        metric['rows_in'] += rows_in or 0
+        metric['rows_out'] += rows_out or 0
+        metric['bytes'] += fetched_bytes or 0
+        metric['peak_rss_bytes'] = peak_rss_bytes()
+
+
+def merge_stages(stages):
+    """ Add the stage metrics of a worker process, see `job_stages`, to the run metrics """
+    with metrics_lock:
+        for stage in stages:
+            metric = stage_metrics.setdefault((stage['job'], stage['stage']), dict(
+                stage, calls=0, seconds=0.0, rows_in=0, rows_out=0, bytes=0, peak_rss_bytes=None))
+            for name in ('calls', 'seconds', 'rows_in', 'rows_out', 'bytes'):
+                metric[name] += stage[name]
+            metric['peak_rss_bytes'] = max(metric['peak_rss_bytes'] or 0, stage['peak_rss_bytes'] or 0)
+
+
+def record_job(job, status, seconds, rows=None):
+    """ Record the outcome of a job: `success`, `failed` or `skipped` """
+    with metrics_lock:
+        job_metrics[job] = {'job': job, 'status': status, 'seconds': seconds,
+                            'rows': rows, 'peak_rss_bytes': peak_rss_bytes()}
+
+
+def timed_frames(job, stage, kind, frames):
+    """ Wrap a generator of frames to record each frame as one call of the stage """
+    while True:
+        start_time = time.perf_counter()
+        frame_df = next(frames, None)
+        if frame_df is None:
+            return
+        seconds = time.perf_counter() - start_time
+        record_stage(job, stage, kind, seconds, None, frame_rows(frame_df),
+                     int(frame_df.memory_usage(deep=True).sum()))
+        yield frame_df
+
+
+def timed_stage(job, stage, kind, function):
+    """ Wrap a job function to record its wall time, rows in/out and fetched bytes
+
+    Extracts returning a generator of frames are recorded frame by frame,
+    as the frames are fetched.
+    """
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start_time
+        if kind == 'extract' and inspect.isgenerator(result):
+            return timed_frames(job, stage, kind, result)
+
+        rows_in = frame_rows(args[0]) if args else None
+        rows_out = frame_rows(result)
+        # Load functions return the number of loaded rows
+        if kind == 'load' and isinstance(result, int):
+            rows_out = result
+
+        fetched_bytes = None
+        if kind in ('extract', 'lookup') and isinstance(result, pd.DataFrame):
+            fetched_bytes = int(result.memory_usage(deep=True).sum())
+        record_stage(job, stage, kind, seconds, rows_in, rows_out, fetched_bytes)
+        return result
+
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def instrument(module, job):
+    """ Wrap the extract, lookup, transform and load functions of a job module
+
+    Stages are found by name prefix, see STAGE_KINDS. The module globals
+    are replaced, so the job's own calls go through the wrappers. A module
+    is instrumented once.
+    """
+    if getattr(module, 'instrumented', False):
+        return module
+
+    for name, function in list(vars(module).items()):
+        kind = stage_kind(name)
+        if kind and inspect.isfunction(function) and function.__module__ == module.__name__:
+            setattr(module, name, timed_stage(job, name, kind, function))
+    module.instrumented = True
+    return module
+
+
+def job_stages(job):
+    """ Stage metrics of one job, slowest first """
+    with metrics_lock:
+        stages = [dict(m) for (j, _), m in stage_metrics.items() if j == job]
+    return sorted(stages, key=lambda m: -m['seconds'])
+
+
+def run_summary():
+    """ Metrics of this run: the jobs and their stages """
+    with metrics_lock:
+        jobs = [dict(m) for m in job_metrics.values()]
+    return {
+        'timestamp': time.time(),
+        'jobs': [dict(m, stages=job_stages(m['job'])) for m in jobs],
+    }
+
+
+def write_atomic(path, text):
+    """ Write a file through a temporary file, readers never see a partial file """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'w') as output_file:
+        output_file.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def write_summary(path, summary=None):
+    """ Write the run summary as JSON """
+    write_atomic(path, json.dumps(summary or run_summary(), indent=2) + '\n')
+
+
+def prometheus_text(summary):
+    """ Prometheus text exposition of a run summary, for the node_exporter textfile collector """
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} gauge'.format(name))
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append('{}{{{}}} {}'.format(name, ','.join(
+                '{}="{}"'.format(k, v) for k, v in labels.items()), value))
+
+    jobs = summary['jobs']
+    stages = [s for job in jobs for s in job['stages']]
+
+    def stage_labels(stage):
+        return {'job': stage['job'], 'stage': stage['stage'], 'kind': stage['kind']}
+
+    lines.append('# HELP etl_run_timestamp_seconds End of the last ETL run')
+    lines.append('# TYPE etl_run_timestamp_seconds gauge')
+    lines.append('etl_run_timestamp_seconds {}'.format(summary['timestamp']))
+    metric('etl_job_success', 'Whether the job succeeded in the last run',
+           [({'job': j['job'], 'status': j['status']}, int(j['status'] == 'success')) for j in jobs])
+    metric('etl_job_seconds', 'Wall time of the job',
+           [({'job': j['job']}, j['seconds']) for j in jobs])
+    metric('etl_job_rows', 'Rows loaded by the job',
+           [({'job': j['job']}, j['rows']) for j in jobs])
+    metric('etl_stage_calls', 'Calls of the stage',
+           [(stage_labels(s), s['calls']) for s in stages])
+    metric('etl_stage_seconds', 'Wall time summed over the calls of the stage',
+           [(stage_labels(s), s['seconds']) for s in stages])
+    metric('etl_stage_rows_in', 'Rows passed to the stage',
+           [(stage_labels(s), s['rows_in']) for s in stages])
+    metric('etl_stage_rows_out', 'Rows returned or loaded by the stage',
+           [(stage_labels(s), s['rows_out']) for s in stages])
+    metric('etl_stage_bytes', 'In-memory bytes of the frames fetched by the stage',
+           [(stage_labels(s), s['bytes']) for s in stages if s['kind'] in ('extract', 'lookup')])
+    metric('etl_stage_peak_rss_bytes', 'Peak RSS of the process at the end of the stage',
+           [(stage_labels(s), s['peak_rss_bytes']) for s in stages])
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, summary=None):
+    """ Write the run summary as a Prometheus textfile """
+    write_atomic(path, prometheus_text(summary or run_summary()))
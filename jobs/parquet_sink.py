@@ -0,0 +1,77 @@
+import os
+import logging
+from lazy import lazy_import
+
+pa = lazy_import('pyarrow')
+pq = lazy_import('pyarrow.parquet')
+pd = lazy_import('pandas')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED PARQUET EXPORT SINK
+############################################
+
+# Hive partition columns of the fact datasets, derived from `date_key`
+PARTITION_COLUMNS = ['year', 'month']
+
+
+def partition_date_key(fact_df):
+    """ Add the `year` and `month` partition columns of a YYYYMMDD `date_key`
+
+    Keys are nullable int64 in every file, whatever dtype the merges of a
+    chunk left them with, so all the files of a dataset share one schema.
+    """
+    keys = {c: fact_df[c].astype('Int64') for c in fact_df.columns if c.endswith('_key')}
+    date_key = keys['date_key']
+    return fact_df.assign(year=date_key // 10000, month=date_key // 100 % 100, **keys)
+
+
+def write_fact_chunk(chunk_df, parquet_dir, table, key):
+    """ Write one loaded chunk to `<parquet_dir>/<table>/year=YYYY/month=M/`
+
+    Files are named after the first `key` of the chunk, a chunk written
+    again by a retried load replaces its files instead of duplicating them.
+    """
+    if chunk_df.shape[0] == 0:
+        return
+    pq.write_to_dataset(
+        pa.Table.from_pandas(partition_date_key(chunk_df), preserve_index=False),
+        os.path.join(parquet_dir, table), partition_cols=PARTITION_COLUMNS,
+        basename_template='{:020d}-{{i}}.parquet'.format(int(chunk_df[key].iloc[0])),
+        existing_data_behavior='overwrite_or_ignore')
+
+
+def fact_sink(parquet_dir, table, key):
+    """ Load callback writing each loaded chunk of a fact table to the Parquet dataset
+
+    It runs in the transaction of the chunk, before the commit, so a chunk
+    whose file can't be written is not committed either.
+    """
+    def sink(connection, chunk_df):
+        write_fact_chunk(chunk_df, parquet_dir, table, key)
+    return sink
+
+
+def snapshot_path(parquet_dir, table):
+    """ Parquet snapshot of a dimension, next to the fact datasets """
+    return os.path.join(parquet_dir, '{}.parquet'.format(table))
+
+
+def export_snapshot(table, database, parquet_dir, refresh=True):
+    """ Write the whole warehouse dimension `table` as a Parquet snapshot
+
+    Dimensions are small and SCD2 updates close existing versions, so the
+    snapshot is rewritten from the warehouse instead of appended to. It is
+    written through a temporary file, readers never see a partial one.
+    Without `refresh` an existing snapshot is kept.
+    """
+    path = snapshot_path(parquet_dir, table)
+    if not refresh and os.path.exists(path):
+        return
+
+    os.makedirs(parquet_dir, exist_ok=True)
+    snapshot_df = pd.read_sql("SELECT * FROM {}".format(table), database)
+    pq.write_table(pa.Table.from_pandas(snapshot_df, preserve_index=False), path + '.tmp')
+    os.replace(path + '.tmp', path)
+    logger.info('parquet table={} rows={} path={}'.format(table, snapshot_df.shape[0], path))
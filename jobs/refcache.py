@@ -0,0 +1,145 @@
+import json
+import os
+import logging
+import threading
+from lazy import lazy_import
+from extract import lookup_by_ids, unique_ids, select_list
+from schema import apply_schema
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED REFERENCE DATA SNAPSHOT CACHE
+############################################
+
+# Snapshots already loaded in this process, keyed by (cache_dir, table)
+snapshots = {}
+
+# One lock per snapshot, jobs running concurrently share the cache files
+snapshot_locks = {}
+
+
+def probe_reference_table(table, database):
+    """ Cheap change probe: row count and latest `last_update` of a source table """
+    query = "SELECT COUNT(*) AS row_count, MAX(last_update) AS max_last_update FROM {}".format(
+        table)
+    probe_df = pd.read_sql(query, database)
+    max_last_update = probe_df.iloc[0]['max_last_update']
+    return {
+        'row_count': int(probe_df.iloc[0]['row_count']),
+        'max_last_update': None if pd.isnull(max_last_update) else str(max_last_update)
+    }
+
+
+def read_snapshot(table, cache_dir):
+    """ Read the cached snapshot of a table and its metadata, or (None, None)
+
+    The metadata holds the probe the snapshot was taken at and the
+    projected columns it contains (None for all columns).
+    """
+    meta_path = os.path.join(cache_dir, '{}.json'.format(table))
+    data_path = os.path.join(cache_dir, '{}.feather'.format(table))
+    if not (os.path.exists(meta_path) and os.path.exists(data_path)):
+        return None, None
+
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    return meta, pd.read_feather(data_path)
+
+
+def write_snapshot(table, snapshot_df, meta, cache_dir):
+    """ Write the snapshot of a table and its metadata to the cache directory """
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path = os.path.join(cache_dir, '{}.json'.format(table))
+    data_path = os.path.join(cache_dir, '{}.feather'.format(table))
+
+    # Write to temporary files first so a crash never leaves a torn snapshot
+    snapshot_df.reset_index(drop=True).to_feather(data_path + '.tmp')
+    os.replace(data_path + '.tmp', data_path)
+    with open(meta_path + '.tmp', 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def covers_columns(snapshot_columns, columns):
+    """ Whether a snapshot of `snapshot_columns` holds all of `columns` (None means all) """
+    if snapshot_columns is None:
+        return True
+    return columns is not None and set(columns) <= set(snapshot_columns)
+
+
+def union_columns(snapshot_columns, columns):
+    """ Columns of a snapshot widened to also hold `columns` (None means all) """
+    if snapshot_columns is None or columns is None:
+        return None
+    return snapshot_columns + [c for c in columns if c not in snapshot_columns]
+
+
+def reference_table(table, key, database, cache_dir, columns=None):
+    """ Return the content of a small reference table through the snapshot cache
+
+    The snapshot is reused as long as the probe is unchanged. Otherwise only
+    rows with `last_update` at or after the cached maximum are fetched and
+    merged in by `key`; a full reload happens only when rows were deleted
+    or when `columns` asks for columns the snapshot doesn't hold yet.
+    """
+    with snapshot_locks.setdefault((cache_dir, table), threading.Lock()):
+        return refresh_reference_table(table, key, database, cache_dir, columns)
+
+
+def refresh_reference_table(table, key, database, cache_dir, columns=None):
+    """ Probe a reference table and bring its snapshot up to date """
+    probe = probe_reference_table(table, database)
+
+    cached = snapshots.get((cache_dir, table))
+    if cached is not None and cached[0]['probe'] == probe and covers_columns(cached[0]['columns'], columns):
+        return cached[1]
+
+    meta, snapshot_df = read_snapshot(table, cache_dir)
+    if meta is not None and (meta.get('probe') is None or not covers_columns(meta['columns'], columns)):
+        columns = union_columns(meta.get('columns'), columns)
+        meta = None
+
+    if meta is not None and meta['probe'] == probe:
+        logger.debug('reference cache hit table={}'.format(table))
+    elif meta is None or meta['probe']['max_last_update'] is None:
+        logger.debug('reference cache full load table={}'.format(table))
+        query = "SELECT {} FROM {}".format(select_list(columns), table)
+        snapshot_df = apply_schema(pd.read_sql(query, database), table)
+        meta = {'probe': probe, 'columns': columns}
+        write_snapshot(table, snapshot_df, meta, cache_dir)
+    else:
+        query = "SELECT {} FROM {} WHERE last_update >= '{}'".format(
+            select_list(meta['columns']), table, meta['probe']['max_last_update'])
+        delta_df = pd.read_sql(query, database)
+        logger.debug('reference cache delta table={} rows={}'.format(
+            table, delta_df.shape[0]))
+
+        snapshot_df = pd.concat([
+            snapshot_df[~snapshot_df[key].isin(delta_df[key])],
+            delta_df
+        ], ignore_index=True)
+        # Rows were deleted in the source, the delta can't tell which ones
+        if snapshot_df.shape[0] != probe['row_count']:
+            query = "SELECT {} FROM {}".format(select_list(meta['columns']), table)
+            snapshot_df = pd.read_sql(query, database)
+        snapshot_df = apply_schema(snapshot_df, table)
+        meta = {'probe': probe, 'columns': meta['columns']}
+        write_snapshot(table, snapshot_df, meta, cache_dir)
+
+    snapshots[(cache_dir, table)] = (meta, snapshot_df)
+    return snapshot_df
+
+
+def lookup_reference(table, key, ids, database, cache_dir, columns=None):
+    """ Lookup rows of a reference table by id, from the snapshot cache when enabled """
+    if not cache_dir:
+        return lookup_by_ids(table, key, ids, database, columns)
+
+    reference_df = reference_table(table, key, database, cache_dir, columns)
+    reference_df = reference_df[reference_df[key].isin(unique_ids(ids))]
+    if columns is not None:
+        reference_df = reference_df[columns]
+    return reference_df.reset_index(drop=True)
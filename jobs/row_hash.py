@@ -0,0 +1,125 @@
+import threading
+import logging
+from functools import lru_cache
+from lazy import lazy_import
+from extract import lookup_by_ids, IN_LIST_SIZE
+from joins import lookup_positions
+from scd2 import NEW, CHANGED, BASELINE
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+db = lazy_import('sqlalchemy')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED ROW HASH CHANGE DETECTION
+############################################
+
+# Columns a hash diff adds to the rows it keeps
+HASH_COLUMNS = ['row_hash', 'row_status']
+
+# Dimensions with a hash table and their natural key
+HASHED_DIMENSIONS = {
+    'dim_customer': 'customer_id',
+    'dim_store': 'store_id',
+    'dim_movie': 'film_id',
+}
+
+# Warehouses and dimensions the hash tables were created for in this process
+created_tables = set()
+created_lock = threading.Lock()
+
+
+def hash_table_name(dimension):
+    """ Hash table stored next to a dimension """
+    return '{}_hash'.format(dimension)
+
+
+@lru_cache(maxsize=None)
+def hash_table(dimension, key):
+    """ The hash of the business columns of the current row of each natural key """
+    return db.Table(
+        hash_table_name(dimension), db.MetaData(),
+        db.Column(key, db.BigInteger, primary_key=True, autoincrement=False),
+        db.Column('row_hash', db.BigInteger, nullable=False),
+    )
+
+
+def create_hash_table(dimension, key, database):
+    """ Create the hash table of a dimension on a warehouse, once per process """
+    with created_lock:
+        name = '{} {}'.format(database.url, dimension)
+        if name not in created_tables:
+            hash_table(dimension, key).create(database, checkfirst=True)
+            created_tables.add(name)
+
+
+def row_hashes(dim_df, columns):
+    """ Vectorized 64-bit hash of `columns` of each row, as int64 for a BIGINT column
+
+    Nullable Int and numpy int columns, categoricals and strings of the same
+    values hash the same, so pushdown and pandas joins agree.
+    """
+    hashes = pd.util.hash_pandas_object(dim_df[columns], index=False)
+    return pd.Series(hashes.to_numpy().view('int64'), index=dim_df.index)
+
+
+def diff_row_hashes(dim_df, dimension, key, columns, database):
+    """ Rows of `dim_df` whose hash differs from the stored one, with their status
+
+    The hashes of the batch are compared in bulk with the stored hashes of
+    its natural keys, unchanged rows are dropped. A key without a stored
+    hash is `new`, or `baseline` when the dimension already has it, e.g.
+    loaded by id before the first hash run. Adds the HASH_COLUMNS.
+    """
+    create_hash_table(dimension, key, database)
+    dim_df = dim_df.assign(row_hash=row_hashes(dim_df, columns), row_status=CHANGED)
+
+    stored_df = lookup_by_ids(hash_table_name(dimension), key, dim_df[key], database, [key, 'row_hash'])
+    stored_df, positions = lookup_positions(stored_df, key, dim_df[key].astype('int64'))
+    found = positions >= 0
+    stored = np.zeros(len(positions), dtype='int64')
+    stored[found] = stored_df['row_hash'].to_numpy(dtype='int64')[positions[found]]
+    keep = ~found | (stored != dim_df['row_hash'].to_numpy())
+    dim_df, unhashed = dim_df[keep].copy(), ~found[keep]
+
+    loaded_ids = lookup_by_ids(dimension, key, dim_df.loc[unhashed, key], database, [key])[key]
+    dim_df.loc[unhashed, 'row_status'] = np.where(
+        dim_df.loc[unhashed, key].isin(loaded_ids), BASELINE, NEW)
+
+    logger.info(' '.join(['hash diff table={} rows={}'.format(dimension, dim_df.shape[0])] + [
+        '{}={}'.format(status, count) for status, count in dim_df['row_status'].value_counts().items()]))
+    return dim_df.reset_index(drop=True)
+
+
+def write_row_hashes(connection, dimension, key, dim_df, columns):
+    """ Replace the stored hashes of the natural keys of `dim_df`, inside the caller's transaction """
+    if dim_df.shape[0] == 0:
+        return
+
+    table = hash_table(dimension, key)
+    rows = [{key: int(k), 'row_hash': int(h)} for k, h in zip(dim_df[key], row_hashes(dim_df, columns))]
+    for start in range(0, len(rows), IN_LIST_SIZE):
+        connection.execute(table.delete().where(
+            table.c[key].in_([row[key] for row in rows[start:start + IN_LIST_SIZE]])))
+    connection.execute(table.insert(), rows)
+
+
+def hash_sink(dimension, key, columns):
+    """ Load callback storing the hashes of each loaded chunk of a dimension
+
+    It runs in the transaction of the chunk, a row is never loaded without
+    its hash, so a retried run doesn't load it twice.
+    """
+    def sink(connection, chunk_df):
+        write_row_hashes(connection, dimension, key, chunk_df, columns)
+    return sink
+
+
+def record_baseline(dim_df, dimension, key, columns, database):
+    """ Store the hashes of the `baseline` rows of a hash diff, return the other rows """
+    baseline = dim_df['row_status'] == BASELINE
+    with database.begin() as connection:
+        write_row_hashes(connection, dimension, key, dim_df[baseline], columns)
+    return dim_df[~baseline]
@@ -0,0 +1,167 @@
+from lazy import lazy_import
+from extract import lookup_by_ids
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+db = lazy_import('sqlalchemy')
+
+############################################
+# SHARED SCD2 SURROGATE KEY RESOLUTION
+############################################
+
+
+def build_scd2_index(dim_df, natural_key, surrogate_key, start_column='start_date', end_column='end_date'):
+    """ Build an interval index over the versions of an SCD2 dimension
+
+    Dates are parsed once here and the versions are sorted by start date,
+    which is the order `resolve_scd2_key` needs for an as-of search.
+    """
+    index_df = pd.DataFrame({
+        natural_key: dim_df[natural_key].to_numpy(),
+        surrogate_key: dim_df[surrogate_key].to_numpy(),
+        'version_start': pd.to_datetime(dim_df[start_column]).astype('datetime64[ns]').to_numpy(),
+        'version_end': pd.to_datetime(dim_df[end_column]).astype('datetime64[ns]').to_numpy(),
+    })
+    index_df = index_df.dropna(subset=[natural_key, 'version_start'])
+    return index_df.sort_values('version_start', kind='stable').reset_index(drop=True)
+
+
+def resolve_scd2_key(fact_df, index_df, natural_key, surrogate_key, date_column):
+    """ Resolve the surrogate key of the version active at `date_column` for each fact row
+
+    Every fact row is matched to the latest version of its natural key that
+    started on or before its date, in O(n log m) and without the rows x
+    versions intermediate of a merge-then-filter. The match is kept only if
+    that version has not ended before the date. Returns a Series aligned
+    with `fact_df`, NaN where no version is active.
+    """
+    row_count = fact_df.shape[0]
+    if row_count == 0 or index_df.shape[0] == 0:
+        return pd.Series(np.nan, index=fact_df.index)
+
+    lookup_df = pd.DataFrame({
+        'row': np.arange(row_count),
+        natural_key: fact_df[natural_key].to_numpy(),
+        'fact_date': pd.to_datetime(fact_df[date_column]).astype('datetime64[ns]').to_numpy(),
+    })
+    lookup_df = lookup_df.dropna(subset=[natural_key, 'fact_date'])
+    lookup_df[natural_key] = lookup_df[natural_key].astype(index_df[natural_key].dtype)
+    lookup_df = lookup_df.sort_values('fact_date', kind='stable')
+
+    matched_df = pd.merge_asof(lookup_df, index_df, left_on='fact_date', right_on='version_start',
+                               by=natural_key, direction='backward')
+    active = matched_df[surrogate_key].notnull() & (
+        matched_df.version_end.isnull() | (matched_df.version_end >= matched_df.fact_date))
+    matched_df = matched_df[active]
+
+    surrogate_keys = pd.Series(matched_df[surrogate_key].to_numpy(),
+                               index=matched_df['row'].to_numpy())
+    return surrogate_keys.reindex(np.arange(row_count)).set_axis(fact_df.index)
+
+
+############################################
+# SHARED SCD2 VERSIONING
+############################################
+
+
+# Status of the rows a versioning diff keeps: `new` natural keys, `changed`
+# ones, and `baseline` ones already in the dimension without a captured
+# change, e.g. loaded by id before the first versioned run
+NEW, CHANGED, BASELINE = 'new', 'changed', 'baseline'
+
+
+def lookup_scd2_versions(table, natural_key, ids, database):
+    """ Lookup the `last_update` of every version of the given natural keys """
+    return lookup_by_ids(table, natural_key, ids, database, [natural_key, 'last_update'])
+
+
+def new_scd2_versions(changes_df, versions_df, natural_key, first_start, start_column='start_date'):
+    """ Turn changed source rows into the dimension versions to insert, with their `row_status`
+
+    A natural key without any version is `new` and starts at `first_start`,
+    so facts older than the first capture still resolve. A key whose
+    versions have no `last_update` is `baseline`: its open version only
+    records the change, see `record_scd2_baseline`. Otherwise a change not
+    newer than the latest version was already applied and is dropped, and
+    a newer one is `changed` and starts at its `last_update`.
+    """
+    latest = versions_df.groupby(natural_key)['last_update'].max()
+    latest.index = latest.index.astype('int64')
+    changes_df = changes_df.copy()
+    changes_df['last_update'] = pd.to_datetime(changes_df['last_update'])
+
+    ids = changes_df[natural_key].astype('int64')
+    known = ids.isin(latest.index)
+    previous = pd.to_datetime(ids.map(latest))
+    changes_df['row_status'] = np.where(~known, NEW, np.where(previous.isnull(), BASELINE, CHANGED))
+    changes_df = changes_df[~known | previous.isnull() | (changes_df['last_update'] > previous)]
+
+    changes_df[start_column] = changes_df['last_update'].astype(str).where(
+        changes_df['row_status'] == CHANGED, first_start)
+    return changes_df.reset_index(drop=True)
+
+
+def record_scd2_baseline(versions_df, table, natural_key, database):
+    """ Stamp the open version of the `baseline` rows with their `last_update`, return the other rows
+
+    Later changes of these keys are then versioned against that date
+    instead of adding a version that duplicates the row.
+    """
+    baseline = versions_df['row_status'] == BASELINE
+    rows = [{'id': int(i), 'last_update': str(u)} for i, u in zip(
+        versions_df.loc[baseline, natural_key], versions_df.loc[baseline, 'last_update'])]
+    if rows:
+        with database.begin() as connection:
+            connection.execute(db.text(
+                "UPDATE {0} SET last_update = :last_update WHERE {1} = :id AND end_date IS NULL".format(
+                    table, natural_key)), rows)
+    return versions_df[~baseline]
+
+
+def close_scd2_versions(connection, table, natural_key, new_versions_df, start_column='start_date',
+                        end_column='end_date'):
+    """ Close the open versions replaced by `new_versions_df` in one UPDATE, inside the caller's transaction
+
+    The end date of each replaced version is the start date of its new
+    version, e.g. its source `last_update` or the time of a hash diff. The
+    pairs are staged in a session temp table so the whole batch is closed
+    by a single set-based statement, whatever its size. Returns the number
+    of closed versions.
+    """
+    replaced_df = new_versions_df[[natural_key, start_column]]
+    if replaced_df.shape[0] == 0:
+        return 0
+
+    # Start dates mix dates and timestamps, each is parsed on its own
+    rows = [{'id': int(i), 'end_date': str(pd.Timestamp(e))} for i, e in zip(
+        replaced_df[natural_key], replaced_df[start_column])]
+
+    # The temp table may outlive a failed chunk on its pooled connection, a
+    # rollback doesn't drop it everywhere
+    connection.exec_driver_sql(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS scd2_changes (id BIGINT NOT NULL PRIMARY KEY, end_date DATETIME)")
+    connection.exec_driver_sql("DELETE FROM scd2_changes")
+    connection.execute(db.text(
+        "INSERT INTO scd2_changes (id, end_date) VALUES (:id, :end_date)"), rows)
+    result = connection.exec_driver_sql(
+        "UPDATE {0} SET {2} = (SELECT c.end_date FROM scd2_changes c WHERE c.id = {0}.{1}) "
+        "WHERE {2} IS NULL AND {1} IN (SELECT id FROM scd2_changes)".format(
+            table, natural_key, end_column))
+
+    # A plain DROP TABLE commits the transaction on MySQL, a temporary one doesn't
+    connection.exec_driver_sql("{} scd2_changes".format(
+        "DROP TEMPORARY TABLE" if connection.dialect.name == 'mysql' else "DROP TABLE"))
+    return result.rowcount
+
+
+def close_replaced_versions(table, natural_key, start_column='start_date', end_column='end_date'):
+    """ Load callback closing the open versions the rows of each chunk replace
+
+    It runs in the transaction of the chunk before its rows are inserted,
+    so a version is never closed without its replacement, and a retried
+    run doesn't close the new version. Rows of natural keys without an
+    open version close nothing.
+    """
+    def close(connection, chunk_df):
+        close_scd2_versions(connection, table, natural_key, chunk_df, start_column, end_column)
+    return close
@@ -0,0 +1,88 @@
+import logging
+from lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED EXTRACT DTYPE SCHEMA
+############################################
+
+# Compact dtypes of the source tables, applied at extract time. Id columns
+# use nullable Int types so NULL foreign keys don't turn them into float64,
+# repetitive strings become categoricals. Columns not listed keep the
+# dtype pandas inferred.
+TABLE_DTYPES = {
+    'payment': {
+        'payment_id': 'Int32', 'customer_id': 'Int32', 'staff_id': 'Int16',
+        'rental_id': 'Int32',
+    },
+    'rental': {
+        'rental_id': 'Int32', 'inventory_id': 'Int32', 'customer_id': 'Int32',
+        'staff_id': 'Int16',
+    },
+    'inventory': {
+        'inventory_id': 'Int32', 'film_id': 'Int32', 'store_id': 'Int16',
+    },
+    'customer': {
+        'customer_id': 'Int32', 'store_id': 'Int16', 'address_id': 'Int32',
+        'active': 'Int8',
+    },
+    'store': {
+        'store_id': 'Int16', 'manager_staff_id': 'Int16', 'address_id': 'Int32',
+    },
+    'staff': {
+        'staff_id': 'Int16', 'address_id': 'Int32', 'store_id': 'Int16',
+        'active': 'Int8',
+    },
+    'address': {
+        'address_id': 'Int32', 'district': 'category', 'city_id': 'Int32',
+    },
+    'city': {
+        'city_id': 'Int32', 'city': 'category', 'country_id': 'Int16',
+    },
+    'country': {
+        'country_id': 'Int16', 'country': 'category',
+    },
+    'film': {
+        'film_id': 'Int32', 'release_year': 'Int16', 'language_id': 'Int16',
+        'original_language_id': 'Int16', 'rental_duration': 'Int8',
+        'length': 'Int16', 'rating': 'category', 'special_features': 'category',
+    },
+    'language': {
+        'language_id': 'Int16', 'name': 'category',
+    },
+}
+
+
+def apply_schema(table_df, table):
+    """ Cast an extracted frame of `table` to its compact dtypes
+
+    A column whose values don't fit its schema dtype (e.g. an id beyond
+    Int16) keeps its inferred dtype instead of failing the extract.
+    """
+    dtypes = TABLE_DTYPES.get(table)
+    if not dtypes:
+        return table_df
+
+    report = logger.isEnabledFor(logging.DEBUG)
+    if report:
+        bytes_before = table_df.memory_usage(deep=True).sum()
+
+    table_df = table_df.copy(deep=False)
+    for column, dtype in dtypes.items():
+        if column not in table_df.columns:
+            continue
+        try:
+            table_df[column] = table_df[column].astype(dtype)
+        except (TypeError, ValueError, OverflowError):
+            logger.warning('schema table={} column={} does not fit {}, keeping {}'.format(
+                table, column, dtype, table_df[column].dtype))
+
+    if report:
+        bytes_after = table_df.memory_usage(deep=True).sum()
+        logger.debug('schema table={} rows={} bytes_before={} bytes_after={} ratio={:.2f}'.format(
+            table, table_df.shape[0], bytes_before, bytes_after,
+            bytes_after / bytes_before if bytes_before else 1))
+    return table_df
@@ -0,0 +1,92 @@
+import configparser
+
+############################################
+# SHARED CONFIG AND JOB SETTINGS
+############################################
+
+CONFIG_PATH = 'conf/.env'
+LOGGING_CONFIG_PATH = 'conf/logging_config.ini'
+
+# Job settings and their defaults, overridden by the [etl] section of
+# conf/.env or by keyword arguments of a job's `run()`
+DEFAULT_SETTINGS = {
+    # batch: one LIMIT batch_size slice per run
+    # stream: keyset pages of batch_size rows until the backlog is drained
+    # cursor: one query read in frames of batch_size rows through a
+    # server-side cursor, see extract.stream_cursor
+    'extract_mode': 'batch',
+    'batch_size': 100000,
+    # stream pages sized to keep the RSS of the job under this many MB,
+    # measured on a first page, 0 to always read batch_size rows
+    'memory_budget_mb': 0,
+    # pandas: pd.read_sql, arrow: Arrow reads (connectorx when installed), see extract.read_frame
+    'extract_backend': 'pandas',
+    # to_sql, multirow, executemany or infile, see loader.LOAD_STRATEGIES
+    'load_strategy': 'to_sql',
+    'load_chunksize': 10000,
+    # local snapshot cache for reference tables, empty to disable
+    'reference_cache_dir': '',
+    # threads for independent lookups inside a job
+    'lookup_workers': 4,
+    # fact_sales worker processes, each loading a disjoint payment_id range
+    # of the backlog, 1 to run in the job's own process
+    'partition_workers': 1,
+    # join source tables in one SELECT on the source database instead of
+    # pandas merges, and optionally check both paths give the same rows
+    'join_pushdown': False,
+    'validate_pushdown': False,
+    # change capture of dim_customer and dim_store: `id` appends new ids,
+    # `last_update` versions every row updated since the last run (SCD2),
+    # `hash` compares a hash of every row with the stored one and only
+    # writes new and changed rows, dim_movie too, see row_hash.diff_row_hashes
+    'change_capture': 'id',
+    # fold each loaded fact_sales chunk into the daily sales summary tables
+    # by store, movie and customer, see aggregates.AGGREGATES
+    'sales_aggregates': False,
+    # Parquet export of the warehouse: fact_sales partitioned by year/month
+    # of date_key and dimension snapshots, empty to disable
+    'parquet_dir': '',
+    # checkpoints of extracted and transformed batches, a failed run resumes
+    # from them instead of extracting again, empty to disable
+    'staging_dir': '',
+    # date range and holiday calendar of dim_date
+    'dim_date_start': '2005-01-01',
+    'dim_date_end': '2006-02-16',
+    'holiday_calendar': 'USFederalHolidayCalendar',
+}
+
+
+def read_config(path=CONFIG_PATH):
+    """ Read the connection and job configuration """
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def setup_logging(path=LOGGING_CONFIG_PATH):
+    """ Configure logging from the logging config file """
+    import logging.config
+    logging.config.fileConfig(path, disable_existing_loggers=False)
+
+
+def etl_settings(config):
+    """ Job settings found in the [etl] section of the config """
+    settings = {}
+    for name, default in DEFAULT_SETTINGS.items():
+        if not config.has_option('etl', name):
+            continue
+        if isinstance(default, bool):
+            settings[name] = config.getboolean('etl', name)
+        elif isinstance(default, int):
+            settings[name] = config.getint('etl', name)
+        else:
+            settings[name] = config.get('etl', name)
+    return settings
+
+
+def resolve_settings(overrides):
+    """ Merge setting overrides into the defaults, rejecting unknown settings """
+    unknown = set(overrides) - set(DEFAULT_SETTINGS)
+    if unknown:
+        raise TypeError('Unknown job setting(s): {}'.format(', '.join(sorted(unknown))))
+    return dict(DEFAULT_SETTINGS, **overrides)
@@ -0,0 +1,116 @@
+import os
+import glob
+import logging
+from lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger()
+
+############################################
+# SHARED CHECKPOINTED BATCH STAGING
+############################################
+
+# Checkpoints of a batch, in the order they are written
+STAGES = ['extracted', 'transformed']
+
+
+def batch_key(source_df, key):
+    """ Key of a staged batch: its first source id, zero padded so keys sort in batch order """
+    return '{:020d}'.format(int(source_df[key].iloc[0]))
+
+
+def stage_path(staging_dir, job, key, stage):
+    """ Arrow IPC file of one checkpoint of a batch """
+    return os.path.join(staging_dir, job, '{}.{}.arrow'.format(key, stage))
+
+
+def write_stage(stage_df, staging_dir, job, key, stage):
+    """ Write a checkpoint through a temporary file, a crash never leaves a torn one """
+    path = stage_path(staging_dir, job, key, stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    stage_df.reset_index(drop=True).to_feather(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def read_stage(staging_dir, job, key, stage):
+    """ Read a checkpoint of a batch, None when it wasn't written """
+    path = stage_path(staging_dir, job, key, stage)
+    if not os.path.exists(path):
+        return None
+    return pd.read_feather(path)
+
+
+def staged_batches(staging_dir, job):
+    """ Keys of the batches of a job left in the staging area, in batch order """
+    paths = glob.glob(os.path.join(staging_dir, job, '*.{}.arrow'.format(STAGES[0])))
+    return sorted(os.path.basename(p).split('.')[0] for p in paths)
+
+
+def clear_batch(staging_dir, job, key):
+    """ Remove the checkpoints of a loaded batch """
+    for stage in STAGES:
+        path = stage_path(staging_dir, job, key, stage)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def not_loaded(key, last_id):
+    """ `pending` filter of a job loading in `key` order: the rows after the warehouse last id """
+    if last_id is None or pd.isnull(last_id):
+        return lambda destination_df: destination_df
+    return lambda destination_df: destination_df[destination_df[key] > last_id]
+
+
+def run_staged(job, source_df, key, transform, load, staging_dir):
+    """ Transform and load one batch, checkpointing it in `staging_dir`
+
+    The extracted and the transformed frame are written before the next
+    step runs and removed once the batch is loaded, so a failed run leaves
+    the batch behind for `resume_staged`. Without a staging directory the
+    batch is only transformed and loaded. Returns the loaded row count.
+    """
+    if not staging_dir:
+        return load(transform(source_df))
+
+    batch = batch_key(source_df, key)
+    write_stage(source_df, staging_dir, job, batch, 'extracted')
+    destination_df = transform(source_df)
+    write_stage(destination_df, staging_dir, job, batch, 'transformed')
+
+    row_count = load(destination_df)
+    clear_batch(staging_dir, job, batch)
+    return row_count
+
+
+def resume_staged(job, transform, load, staging_dir, pending=None):
+    """ Finish the batches a failed run left in `staging_dir`, returns the loaded row count
+
+    A batch restarts from its last checkpoint, the source is never queried
+    again. `pending` keeps the rows of a transformed batch that are not in
+    the warehouse yet, a load may have failed half way. Without it the
+    transformed checkpoint isn't trusted and the batch is transformed again
+    from its extracted checkpoint.
+    """
+    if not staging_dir:
+        return 0
+
+    row_count = 0
+    for batch in staged_batches(staging_dir, job):
+        destination_df = None
+        if pending is not None:
+            destination_df = read_stage(staging_dir, job, batch, 'transformed')
+
+        if destination_df is None:
+            logger.info('staging job={} batch={} resume=extracted'.format(job, batch))
+            destination_df = transform(read_stage(staging_dir, job, batch, 'extracted'))
+            write_stage(destination_df, staging_dir, job, batch, 'transformed')
+        else:
+            logger.info('staging job={} batch={} resume=transformed'.format(job, batch))
+
+        if pending is not None:
+            destination_df = pending(destination_df)
+
+        row_count += load(destination_df)
+        clear_batch(staging_dir, job, batch)
+    return row_count
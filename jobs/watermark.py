@@ -0,0 +1,96 @@
+import threading
+from datetime import datetime
+from functools import lru_cache
+from lazy import lazy_import
+
+pd = lazy_import('pandas')
+db = lazy_import('sqlalchemy')
+
+############################################
+# SHARED WATERMARK CONTROL TABLE
+############################################
+
+WATERMARK_TABLE = 'etl_watermark'
+
+# Warehouses the control table was created on in this process
+created_tables = set()
+created_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def watermark_table():
+    """ The `etl_watermark` control table: one row per job, keyed by job name
+
+    `last_id` is the last loaded source id, `last_update` the last captured
+    source `last_update` of jobs versioning changed rows, with `last_id` as
+    tie breaker between rows updated at the same time.
+    """
+    return db.Table(
+        WATERMARK_TABLE, db.MetaData(),
+        db.Column('job', db.String(64), primary_key=True),
+        db.Column('last_id', db.BigInteger),
+        db.Column('last_update', db.DateTime),
+        db.Column('updated_at', db.DateTime),
+    )
+
+
+def create_watermark_table(database):
+    """ Create the control table on a warehouse, once per process """
+    with created_lock:
+        if str(database.url) not in created_tables:
+            watermark_table().create(database, checkfirst=True)
+            created_tables.add(str(database.url))
+
+
+def read_watermark(job, database):
+    """ Watermark of a job as a dict, None when the job never advanced it """
+    create_watermark_table(database)
+    table = watermark_table()
+    with database.connect() as connection:
+        row = connection.execute(
+            db.select(table.c.last_id, table.c.last_update).where(table.c.job == job)
+        ).mappings().first()
+    return dict(row) if row is not None else None
+
+
+def write_watermark(connection, job, last_id=None, last_update=None):
+    """ Set the watermark of a job on `connection`, inside the caller's transaction """
+    table = watermark_table()
+    values = {
+        'last_id': None if last_id is None or pd.isnull(last_id) else int(last_id),
+        'last_update': None if last_update is None or pd.isnull(last_update)
+        else pd.Timestamp(last_update).to_pydatetime(),
+        'updated_at': datetime.now(),
+    }
+    result = connection.execute(table.update().where(table.c.job == job).values(**values))
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(job=job, **values))
+
+
+def advance_watermark(job, key, update_column=None):
+    """ Load callback advancing the watermark of `job` to the last row of each loaded chunk
+
+    The frame must be loaded in watermark order: by `key`, or by
+    `update_column` then `key` for jobs capturing changed rows.
+    """
+    def advance(connection, chunk_df):
+        last_row = chunk_df.iloc[-1]
+        write_watermark(connection, job, last_row[key],
+                        last_row[update_column] if update_column else None)
+    return advance
+
+
+def advance_id_watermark(job, table, key, database):
+    """ Load callback advancing the id watermark of `job` to the largest `key` of `table`
+
+    For loads not in key order, e.g. versioned changes or hash diffs, so
+    the job loading by id resumes after every key they loaded instead of
+    loading it again. It runs after the rows of the chunk are inserted.
+    The control table is created first, outside the chunk transactions.
+    """
+    create_watermark_table(database)
+
+    def advance(connection, chunk_df):
+        last_id = connection.execute(db.text("SELECT MAX({}) FROM {}".format(key, table))).scalar()
+        write_watermark(connection, job, last_id)
+    return advance
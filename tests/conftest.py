@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The jobs import each other by module name, as when run from `jobs/`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'jobs'))
@@ -0,0 +1,43 @@
+from decimal import Decimal
+import sqlalchemy as db
+from generate_sakila import create_warehouse
+from watermark import read_watermark
+from aggregates import FOLD_JOB, reconcile_aggregates
+
+
+def load_sales(database, first_key, last_key):
+    # Three stores, 0.1 doesn't add up exactly in floats
+    with database.begin() as connection:
+        connection.execute(db.text(
+            "INSERT INTO fact_sales (sales_key, date_key, store_key, sales_amount) "
+            "VALUES (:sales_key, 20050524, :store_key, 0.1)"),
+            [{'sales_key': k, 'store_key': k % 3} for k in range(first_key, last_key + 1)])
+
+
+def store_sales(database):
+    with database.connect() as connection:
+        return connection.execute(db.text(
+            "SELECT store_key, sales_amount, sales_count FROM agg_daily_store_sales ORDER BY store_key"
+        )).fetchall()
+
+
+def test_reconcile_folds_sales_loaded_without_aggregates(tmp_path):
+    database = db.create_engine('sqlite:///{}'.format(tmp_path / 'dw.db'))
+    create_warehouse(database)
+
+    # Tables created on a warehouse with sales are built from fact_sales
+    load_sales(database, 1, 300)
+    reconcile_aggregates(database, 300)
+    assert store_sales(database) == [(0, Decimal('10.00'), 100), (1, Decimal('10.00'), 100),
+                                     (2, Decimal('10.00'), 100)]
+
+    # Sales loaded while the aggregates were off are folded by the next run
+    load_sales(database, 301, 600)
+    reconcile_aggregates(database, 600)
+    assert store_sales(database) == [(0, Decimal('20.00'), 200), (1, Decimal('20.00'), 200),
+                                     (2, Decimal('20.00'), 200)]
+    assert read_watermark(FOLD_JOB, database)['last_id'] == 600
+
+    # Nothing is folded twice
+    reconcile_aggregates(database, 600)
+    assert store_sales(database)[0] == (0, Decimal('20.00'), 200)
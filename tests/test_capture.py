@@ -0,0 +1,51 @@
+import pytest
+from benchmark import create_benchmark_engine
+from engines import Engines
+from generate_sakila import generate_sakila, write_sakila, create_warehouse
+import etl_dim_customer
+
+
+@pytest.fixture
+def engines(tmp_path):
+    tables = generate_sakila()
+    source = create_benchmark_engine('sqlite:///{}'.format(tmp_path / 'sakila.db'))
+    write_sakila({t: tables[t] for t in ['country', 'city', 'address', 'customer']}, source)
+    warehouse = create_benchmark_engine('sqlite:///{}'.format(tmp_path / 'dw.db'))
+    create_warehouse(warehouse)
+    return Engines(source, warehouse)
+
+
+def open_versions(database, customer_id):
+    with database.connect() as connection:
+        return connection.exec_driver_sql(
+            "SELECT email FROM dim_customer WHERE customer_id = {} AND end_date IS NULL".format(
+                customer_id)).fetchall()
+
+
+@pytest.mark.parametrize('extract_mode', ['batch', 'stream'])
+def test_last_update_watermark_passes_baseline_pages(engines, extract_mode):
+    assert etl_dim_customer.run(engines, change_capture='last_update') == 599
+
+    # New customers loaded by id are baseline for the versioned runs, and
+    # every one of them sorts before the change of customer 5
+    with engines.db_engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO customer SELECT customer_id + 599, store_id, first_name, last_name, email, "
+            "address_id, active, create_date, last_update FROM customer WHERE customer_id <= 389")
+    assert etl_dim_customer.run(engines, change_capture='id') == 389
+    with engines.db_engine.begin() as connection:
+        connection.exec_driver_sql(
+            "UPDATE customer SET email = 'new@a.org', last_update = '2007-01-01 00:00:00' "
+            "WHERE customer_id = 5")
+
+    # Each batch run stamps 100 baseline rows and moves on, the fourth one
+    # reaches the change
+    runs = 4 if extract_mode == 'batch' else 1
+    row_counts = [etl_dim_customer.run(engines, change_capture='last_update', batch_size=100,
+                                       extract_mode=extract_mode) for _ in range(runs)]
+    assert row_counts[-1] == 1 and sum(row_counts) == 1
+    assert open_versions(engines.dw_engine, 5) == [('new@a.org',)]
+
+    # Nothing is left to capture
+    assert etl_dim_customer.run(engines, change_capture='last_update', batch_size=100,
+                                extract_mode=extract_mode) == 0
@@ -0,0 +1,50 @@
+from decimal import Decimal
+import pytest
+from extract import arrow_frame, lookup_by_ids, extract_batches
+
+
+def test_arrow_frame_widens_decimal_chunks():
+    # Each chunk infers its own precision: decimal128(3, 2), then decimal128(4, 2)
+    frame_df = arrow_frame(['amount', 'customer_id'], [
+        [(Decimal('9.99'), 1), (Decimal('0.99'), 2)],
+        [(Decimal('11.99'), None)],
+        [(None, 3)],
+    ])
+
+    assert frame_df['amount'].tolist()[:3] == [Decimal('9.99'), Decimal('0.99'), Decimal('11.99')]
+    assert frame_df['amount'].isnull().tolist() == [False, False, False, True]
+    assert str(frame_df['customer_id'].dtype) == 'Int64'
+
+
+def test_arrow_frame_column_without_values():
+    frame_df = arrow_frame(['end_date'], [[(None,), (None,)], [(None,)]])
+
+    assert frame_df.shape == (3, 1)
+    assert frame_df['end_date'].isnull().all()
+
+
+def test_lookup_of_no_ids_is_built_locally():
+    # No database: an empty lookup with known columns never queries it
+    lookup_df = lookup_by_ids('payment', 'payment_id', [None], None, ['payment_id', 'amount'])
+
+    assert lookup_df.shape == (0, 2)
+    assert list(lookup_df.columns) == ['payment_id', 'amount']
+    assert str(lookup_df['payment_id'].dtype) == 'Int32'
+
+
+def test_extract_batches_by_mode():
+    def extract(last_id, database, batch_size, chunksize=None):
+        return ('extract', last_id, batch_size, chunksize)
+
+    def stream(last_id, database, batch_size):
+        return ('stream', last_id, batch_size)
+
+    assert extract_batches('batch', extract, stream, 7, None, 100) == [('extract', 7, 100, None)]
+    assert extract_batches('batch', extract, stream, 7, None, 100, pages=True) == ('stream', 7, 100)
+    assert extract_batches('stream', extract, stream, 7, None, 100, len) == ('stream', 7, len)
+    assert extract_batches('cursor', extract, stream, 7, None, 100) == ('extract', 7, None, 100)
+
+
+def test_extract_batches_rejects_unknown_mode():
+    with pytest.raises(ValueError, match='Unknown extract mode: steam'):
+        extract_batches('steam', None, None, 7, None, 100)
@@ -0,0 +1,55 @@
+import pytest
+from benchmark import create_benchmark_engine
+from engines import Engines
+from generate_sakila import generate_sakila, write_sakila, create_warehouse
+from watermark import read_watermark, write_watermark
+from etl import load_job
+import etl_fact_sales
+from etl_fact_sales import PARTITIONED_JOB, partition_ranges
+
+
+@pytest.mark.parametrize('first_id, last_id, partitions, ranges', [
+    (1, 10, 2, [(0, 5), (5, 10)]),
+    (1, 10, 3, [(0, 4), (4, 8), (8, 10)]),
+    (101, 110, 1, [(100, 110)]),
+    # More partitions than ids: one id each
+    (1, 3, 8, [(0, 1), (1, 2), (2, 3)]),
+    (7, 7, 4, [(6, 7)]),
+])
+def test_partition_ranges(first_id, last_id, partitions, ranges):
+    assert partition_ranges(first_id, last_id, partitions) == ranges
+
+
+@pytest.fixture
+def engines(tmp_path):
+    source = create_benchmark_engine('sqlite:///{}'.format(tmp_path / 'sakila.db'))
+    write_sakila(generate_sakila(), source)
+    warehouse = create_benchmark_engine('sqlite:///{}'.format(tmp_path / 'dw.db'))
+    create_warehouse(warehouse)
+    engines = Engines(source, warehouse)
+    for job in ['dim_customer', 'dim_store', 'dim_movie', 'dim_date']:
+        load_job(job).run(engines)
+    return engines
+
+
+def test_retry_after_failed_partition(engines):
+    assert etl_fact_sales.run(engines) == 16049
+
+    # A partitioned run of four ranges whose second and fourth partitions
+    # failed: the other ones are loaded past the watermark
+    with engines.dw_engine.begin() as connection:
+        connection.exec_driver_sql(
+            "DELETE FROM fact_sales WHERE sales_key > 4000 AND sales_key <= 8000 OR sales_key > 12000")
+        write_watermark(connection, 'fact_sales', 0)
+        write_watermark(connection, PARTITIONED_JOB, 16049)
+
+    # Retried without partitions, batch by batch
+    row_counts = [etl_fact_sales.run(engines, batch_size=3000, partition_workers=1) for _ in range(7)]
+    assert sum(row_counts) == 8049 and row_counts[-1] == 0
+
+    with engines.dw_engine.connect() as connection:
+        counts = connection.exec_driver_sql(
+            "SELECT count(*), count(DISTINCT sales_key), max(sales_key) FROM fact_sales").fetchone()
+    assert tuple(counts) == (16049, 16049, 16049)
+    assert read_watermark('fact_sales', engines.dw_engine)['last_id'] == 16049
+    assert read_watermark(PARTITIONED_JOB, engines.dw_engine)['last_id'] is None
@@ -0,0 +1,52 @@
+import pandas as pd
+import sqlalchemy as db
+from row_hash import (NEW, CHANGED, BASELINE, HASH_COLUMNS, create_hash_table, row_hashes, diff_row_hashes,
+                      write_row_hashes)
+
+COLUMNS = ['customer_id', 'email', 'active']
+
+
+def customers(*rows):
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def test_diff_classifies_new_changed_and_baseline_rows(tmp_path):
+    database = db.create_engine('sqlite:///{}'.format(tmp_path / 'dw.db'))
+    with database.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE dim_customer (customer_id INTEGER, email TEXT, active INTEGER)")
+        connection.exec_driver_sql(
+            "INSERT INTO dim_customer VALUES (1, 'a@a.org', 1), (2, 'b@a.org', 1), (3, 'c@a.org', 1)")
+
+    # Customers 1 and 2 were hashed, 3 was loaded by id before the first hash run
+    create_hash_table('dim_customer', 'customer_id', database)
+    with database.begin() as connection:
+        write_row_hashes(connection, 'dim_customer', 'customer_id',
+                         customers((1, 'a@a.org', 1), (2, 'b@a.org', 1)), COLUMNS)
+
+    result_df = diff_row_hashes(
+        customers((1, 'a@a.org', 1), (2, 'b@a.org', 0), (3, 'c@a.org', 1), (4, 'd@a.org', 1)),
+        'dim_customer', 'customer_id', COLUMNS, database)
+
+    # Customer 1 is unchanged and dropped
+    assert result_df['customer_id'].tolist() == [2, 3, 4]
+    assert result_df['row_status'].tolist() == [CHANGED, BASELINE, NEW]
+    assert result_df.columns.tolist() == COLUMNS + HASH_COLUMNS
+    assert result_df['row_hash'].tolist() == row_hashes(result_df, COLUMNS).tolist()
+
+
+def test_hashes_are_stable_across_dtypes():
+    plain_df = customers((1, 'a@a.org', 1), (2, None, 0))
+    compact_df = plain_df.astype({'customer_id': 'Int32', 'email': 'category', 'active': 'int8'})
+
+    assert plain_df['customer_id'].dtype == 'int64'
+    assert row_hashes(compact_df, COLUMNS).tolist() == row_hashes(plain_df, COLUMNS).tolist()
+    # The same frame hashes the same on every run
+    assert row_hashes(plain_df, COLUMNS).tolist() == row_hashes(plain_df.copy(), COLUMNS).tolist()
+    assert row_hashes(plain_df, COLUMNS).dtype == 'int64'
+
+
+def test_hashes_differ_on_any_column():
+    base_df = customers((1, 'a@a.org', 1))
+    hashes = {int(row_hashes(frame_df, COLUMNS).iloc[0]) for frame_df in [
+        base_df, customers((1, 'A@a.org', 1)), customers((1, 'a@a.org', 0)), customers((1, None, 1))]}
+    assert len(hashes) == 4
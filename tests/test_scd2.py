@@ -0,0 +1,74 @@
+import pandas as pd
+import sqlalchemy as db
+from scd2 import NEW, CHANGED, BASELINE, new_scd2_versions, record_scd2_baseline
+
+FIRST_START = '1970-01-01'
+
+
+def changes(*rows):
+    return pd.DataFrame(rows, columns=['customer_id', 'email', 'last_update'])
+
+
+def versions(*rows):
+    return pd.DataFrame(rows, columns=['customer_id', 'last_update'])
+
+
+def test_new_changed_and_applied_rows():
+    versions_df = versions(
+        (1, '2006-02-15 04:34:33'),
+        (2, '2006-02-15 04:34:33'),
+        (2, '2006-03-01 10:00:00'),
+    )
+    changes_df = changes(
+        (1, 'new@a.org', '2006-04-01 12:00:00'),
+        (2, 'old@a.org', '2006-03-01 10:00:00'),
+        (3, 'first@a.org', '2006-04-02 08:00:00'),
+    )
+
+    result_df = new_scd2_versions(changes_df, versions_df, 'customer_id', FIRST_START)
+
+    # Customer 2 was already versioned at that `last_update`
+    assert result_df['customer_id'].tolist() == [1, 3]
+    assert result_df['row_status'].tolist() == [CHANGED, NEW]
+    assert result_df['start_date'].tolist() == ['2006-04-01 12:00:00', FIRST_START]
+
+
+def test_rows_loaded_by_id_are_baseline():
+    # Loaded by id, the versions have no `last_update`
+    versions_df = versions((1, None), (2, None))
+    changes_df = changes(
+        (1, 'a@a.org', '2006-02-15 04:34:33'),
+        (2, 'b@a.org', '2006-02-15 04:34:33'),
+        (5, 'c@a.org', '2006-02-15 04:34:33'),
+    )
+
+    result_df = new_scd2_versions(changes_df, versions_df, 'customer_id', FIRST_START)
+
+    assert result_df['row_status'].tolist() == [BASELINE, BASELINE, NEW]
+    assert result_df['start_date'].tolist() == [FIRST_START] * 3
+
+
+def test_record_baseline_stamps_open_versions(tmp_path):
+    database = db.create_engine('sqlite:///{}'.format(tmp_path / 'dw.db'))
+    with database.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE dim_customer (customer_id INTEGER, start_date TEXT, end_date TEXT, last_update TEXT)")
+        connection.exec_driver_sql(
+            "INSERT INTO dim_customer VALUES (1, '1970-01-01', NULL, NULL), (2, '1970-01-01', NULL, NULL)")
+
+    versions_df = new_scd2_versions(
+        changes((1, 'a@a.org', '2006-02-15 04:34:33'), (3, 'c@a.org', '2006-02-15 04:34:33')),
+        versions((1, None), (2, None)), 'customer_id', FIRST_START)
+    versions_df = record_scd2_baseline(versions_df, 'dim_customer', 'customer_id', database)
+    assert versions_df['customer_id'].tolist() == [3]
+
+    with database.connect() as connection:
+        stamped = connection.exec_driver_sql(
+            "SELECT customer_id, last_update FROM dim_customer ORDER BY customer_id").fetchall()
+    assert stamped == [(1, '2006-02-15 04:34:33'), (2, None)]
+
+    # The next run finds the change already applied
+    versions_df = new_scd2_versions(
+        changes((1, 'a@a.org', '2006-02-15 04:34:33')),
+        versions((1, '2006-02-15 04:34:33')), 'customer_id', FIRST_START)
+    assert versions_df.shape[0] == 0